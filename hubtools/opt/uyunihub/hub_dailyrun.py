@@ -3,7 +3,7 @@
 # (c) 2020 SUSE Linux GmbH, Germany.
 # GNU Public License. No warranty. No Support
 #
-# Version: 2021-01-28
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis,
 #
@@ -14,13 +14,17 @@
 # Releases:
 # 2020-12-01 M.Brookhuis - initial release.
 # 2021-01-28 M.Brookhuis - Making ready for uyuni
+# 2026-10-19 - List configuration channels instead of projects, collect all data in parallel over https
 #
 #
 
 
 import os
 import sys
+import threading
+import time
 import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 import yaml
 import logging
@@ -49,6 +53,8 @@ else:
     with open(os.path.dirname(__file__) + '/smconfig.yaml') as h_cfg:
         uyunihub = yaml.Loader(h_cfg).get_single_data()
 
+client_pool = threading.local()
+
 
 def write_form_yml(clm_projects, base_channels, slaves, config_channels):
     src = "/srv/formula_metadata/uyunihub/form.yml"
@@ -178,24 +184,44 @@ hub:
     f.close()
 
 
-def get_config_channels(session, client):
-    all_configs = None
+def get_client():
+    """
+    Return the XML-RPC client of the current thread. Every thread keeps its own https connection open, so the
+    listings running in parallel don't share (and don't renegotiate) a connection.
+    """
+    if not hasattr(client_pool, 'client'):
+        client_pool.client = xmlrpc.client.ServerProxy("https://{}/rpc/api".format(uyunihub['server']['hubmaster']))
+    return client_pool.client
+
+
+def timed_call(method, session, *args):
+    start = time.monotonic()
+    call = get_client()
+    for name in method.split('.'):
+        call = getattr(call, name)
+    result = call(session, *args)
+    log.info("{} took {:.2f} seconds".format(method, time.monotonic() - start))
+    return result
+
+
+def get_config_channels(session):
+    all_configs = []
     try:
-        all_configs = client.contentmanagement.listProjects(session)
+        all_configs = timed_call('configchannel.listGlobals', session)
     except xmlrpc.client.Fault as err:
-        log.error('Unable to receive a list of project.')
+        log.error('Unable to receive a list of configuration channels.')
         log.error('Error:')
         log.error(err)
-    apr = []
-    for project in all_configs:
-        apr.append(project.get('label'))
-    return apr
+    acc = []
+    for config in all_configs:
+        acc.append(config.get('label'))
+    return acc
 
 
-def get_clm_projects(session, client):
-    all_projects = None
+def get_clm_projects(session):
+    all_projects = []
     try:
-        all_projects = client.contentmanagement.listProjects(session)
+        all_projects = timed_call('contentmanagement.listProjects', session)
     except xmlrpc.client.Fault as err:
         log.error('Unable to receive a list of project.')
         log.error('Error:')
@@ -206,10 +232,10 @@ def get_clm_projects(session, client):
     return apr
 
 
-def get_base_channels(session, client):
-    all_channels = None
+def get_base_channels(session):
+    all_channels = []
     try:
-        all_channels = client.channel.listSoftwareChannels(session)
+        all_channels = timed_call('channel.listSoftwareChannels', session)
     except xmlrpc.client.Fault as err:
         log.error("Unable to connect SUSE Manager to login to get a list of all software channels")
         log.error('Error:')
@@ -221,10 +247,10 @@ def get_base_channels(session, client):
     return abcl
 
 
-def get_slaves(session, client):
-    all_slaves = None
+def get_slaves(session):
+    all_slaves = []
     try:
-        all_slaves = client.system.listSystems(session)
+        all_slaves = timed_call('system.listSystems', session)
     except xmlrpc.client.Fault as err:
         log.error("Unable to connect SUSE Manager to login to get a list of all systems")
         log.error('Error:')
@@ -235,10 +261,10 @@ def get_slaves(session, client):
     return slaves
 
 
-def get_slaves_systemgroup(session, client, systemgroup):
-    all_slaves = None
+def get_slaves_systemgroup(session, systemgroup):
+    all_slaves = []
     try:
-        all_slaves = client.systemgroup.listSystemsMinimal(session, systemgroup)
+        all_slaves = timed_call('systemgroup.listSystemsMinimal', session, systemgroup)
     except xmlrpc.client.Fault as err:
         log.error("Unable to get a list of systems for systemgroup {}".format(systemgroup))
         log.error('Error:')
@@ -249,20 +275,32 @@ def get_slaves_systemgroup(session, client, systemgroup):
     return slaves
 
 
+def collect(session, systemgroup=None):
+    """
+    Run all listings needed for form.yml at the same time, so the collection costs one round-trip instead of four.
+    """
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        if systemgroup:
+            slaves = executor.submit(get_slaves_systemgroup, session, systemgroup)
+        else:
+            slaves = executor.submit(get_slaves, session)
+        clm_projects = executor.submit(get_clm_projects, session)
+        base_channels = executor.submit(get_base_channels, session)
+        config_channels = executor.submit(get_config_channels, session)
+    log.info("Collecting data took {:.2f} seconds".format(time.monotonic() - start))
+    return clm_projects.result(), base_channels.result(), slaves.result(), config_channels.result()
+
+
 def main():
-    client = xmlrpc.client.Server("http://{}/rpc/api".format(uyunihub['server']['hubmaster']))
+    client = get_client()
     session_key = client.auth.login(uyunihub['server']['user'], uyunihub['server']['password'])
-    if len(sys.argv) == 1:
-        slaves = get_slaves_systemgroup(session_key, client, sys.argv[1])
-    elif len(sys.argv) > 1:
-        log.error("Usage: hub_dailyrun.py")
+    if len(sys.argv) > 2:
+        log.error("Usage: hub_dailyrun.py [systemgroup]")
         client.auth.logout(session_key)
         sys.exit(1)
-    else:
-        slaves = get_slaves(session_key, client)
-    clm_projects = get_clm_projects(session_key, client)
-    base_channels = get_base_channels(session_key, client)
-    config_channels = get_config_channels(session_key, client)
+    systemgroup = sys.argv[1] if len(sys.argv) == 2 else None
+    clm_projects, base_channels, slaves, config_channels = collect(session_key, systemgroup)
     write_form_yml(clm_projects, base_channels, slaves, config_channels)
     client.auth.logout(session_key)
 
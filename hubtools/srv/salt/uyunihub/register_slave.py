@@ -3,7 +3,7 @@
 # (c) 2020 SUSE Linux GmbH, Germany.
 # GNU Public License. No warranty. No Support 
 #
-# Version: 2021-01-28
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis,
 #
@@ -12,6 +12,7 @@
 # Releases:
 # 2020-12-01 M.Brookhuis - initial release.
 # 2021-01-28 M.Brookhuis - Making ready for uyuni
+# 2026-10-19 - Only change the slave and master registration when needed. Use --recreate to start over.
 
 
 import os
@@ -56,65 +57,96 @@ else:
     with open(os.path.dirname(__file__) + '/uyunihub.yaml') as h_cfg:
         uyunihub = load_yaml(h_cfg)
 
-if len(sys.argv) != 1:
-    log.error("Usage: register_master.py")
+ca_cert = "/etc/pki/trust/anchors/RHN-ORG-TRUSTED-SSL-CERT"
+
+
+def reconcile_slave(client, session_key, recreate):
+    """
+    Make sure this server is registered as slave on the master with all orgs allowed. Only the calls needed to get
+    there are done.
+    """
+    slave = None
+    try:
+        slave = client.sync.slave.getSlaveByName(session_key, hub_slave)
+    except xmlrpc.client.Fault:
+        pass
+    if slave and recreate:
+        client.sync.slave.delete(session_key, slave["id"])
+        log.info("Pre-existing Slave deleted.")
+        slave = None
+    if not slave:
+        slave = client.sync.slave.create(session_key, hub_slave, True, True)
+        log.info("Slave added to this Master.")
+    elif not slave.get("enabled") or not slave.get("allowAllOrgs"):
+        client.sync.slave.update(session_key, slave["id"], hub_slave, True, True)
+        log.info("Slave enabled for all orgs.")
+    else:
+        log.info("Slave already registered on this Master.")
+
+    wanted = set([org["id"] for org in client.org.listOrgs(session_key)])
+    current = set(client.sync.slave.getAllowedOrgs(session_key, slave["id"]))
+    if wanted == current:
+        log.info("All orgs already exported.")
+        return
+    result = client.sync.slave.setAllowedOrgs(session_key, slave["id"], list(wanted))
+    if result != 1:
+        log.error("Got error %d on setAllowedOrgs" % result)
+        sys.exit(1)
+    log.info("All orgs exported.")
+
+
+def reconcile_master(client, session_key, recreate):
+    """
+    Make sure the hub master is the default master of this server with the right CA cert. Only the calls needed to
+    get there are done.
+    """
+    master = None
+    try:
+        master = client.sync.master.getMasterByLabel(session_key, uyunihub['server']['hubmaster'])
+    except xmlrpc.client.Fault:
+        pass
+    if master and recreate:
+        client.sync.master.delete(session_key, master["id"])
+        log.info("Pre-existing Master deleted.")
+        master = None
+    if not master:
+        master = client.sync.master.create(session_key, uyunihub['server']['hubmaster'])
+        log.info("Master added to this Slave.")
+    else:
+        log.info("Master already registered on this Slave.")
+
+    if not master.get("isCurrentMaster"):
+        result = client.sync.master.makeDefault(session_key, master["id"])
+        if result != 1:
+            log.error("Got error %d on makeDefault" % result)
+            sys.exit(1)
+        log.info("Master made default.")
+
+    if master.get("caCert") != ca_cert:
+        result = client.sync.master.setCaCert(session_key, master["id"], ca_cert)
+        if result != 1:
+            log.error("Got error %d on setCaCert" % result)
+            sys.exit(1)
+        log.info("CA cert path set.")
+
+
+if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != "--recreate"):
+    log.error("Usage: register_slave.py [--recreate]")
     sys.exit(1)
+recreate = len(sys.argv) == 2
 
 hub_slave = socket.getfqdn()
 
 manager_url = "http://{}/rpc/api".format(uyunihub['server']['hubmaster'])
 client = xmlrpc.client.Server(manager_url)
 session_key = client.auth.login(uyunihub['server']['user'], uyunihub['server']['password'])
-
-try:
-    previous_slave = client.sync.slave.getSlaveByName(session_key, hub_slave)
-    client.sync.slave.delete(session_key, previous_slave["id"])
-    log.info("Pre-existing Slave deleted.")
-except:
-    pass
-
-slave = client.sync.slave.create(session_key, hub_slave, True, True)
-
-log.info("Slave added to this Master.")
-
-orgs = client.org.listOrgs(session_key)
-result = client.sync.slave.setAllowedOrgs(session_key, slave["id"], [org["id"] for org in orgs])
-if result != 1:
-    log.error("Got error %d on setAllowedOrgs" % result)
-    sys.exit(1)
-
-log.info("All orgs exported.")
-
+reconcile_slave(client, session_key, recreate)
 client.auth.logout(session_key)
 
 manager_url = "http://{}/rpc/api".format(hub_slave)
 client = xmlrpc.client.Server(manager_url)
 session_key = client.auth.login(uyunihub['server']['user'], uyunihub['server']['password'])
-
-try:
-    previous_master = client.sync.master.getMasterByLabel(session_key, uyunihub['server']['hubmaster'])
-    client.sync.master.delete(session_key, previous_master["id"])
-    log.info("Pre-existing Master deleted.")
-except:
-    pass
-
-master = client.sync.master.create(session_key, uyunihub['server']['hubmaster'])
-
-log.info("Master added to this Slave.")
-
-result = client.sync.master.makeDefault(session_key, master["id"])
-if result != 1:
-    log.error("Got error %d on makeDefault" % result)
-    sys.exit(1)
-
-log.info("Master made default.")
-
-result = client.sync.master.setCaCert(session_key, master["id"], "/etc/pki/trust/anchors/RHN-ORG-TRUSTED-SSL-CERT")
-if result != 1:
-    log.error("Got error %d on setCaCert" % result)
-    sys.exit(1)
-
-log.info("CA cert path set.")
+reconcile_master(client, session_key, recreate)
 client.auth.logout(session_key)
 
 log.info("Done.")
@@ -3,7 +3,7 @@
 # (c) 2020 SUSE Linux GmbH, Germany.
 # GNU Public License. No warranty. No Support 
 #
-# Version: 2021-01-28
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis,
 #
@@ -12,10 +12,13 @@
 # Releases:
 # 2020-12-01 M.Brookhuis - initial release.
 # 2021-01-28 M.Brookhuis - Making ready for uyuni
+# 2026-10-19 - Only transfer changed files, keep file metadata
 #
 #
 
 
+import base64
+import hashlib
 import logging
 import os
 import socket
@@ -47,168 +50,197 @@ log.setLevel(logging.DEBUG)
 log.addHandler(console)
 log.addHandler(fh)
 
+# digests and metadata of the files synced during the last run
+manifest_name = os.path.dirname(__file__) + "/config_manifest.yaml"
+# metadata that is kept when a file is copied to the slave
+file_meta = ['type', 'owner', 'group', 'permissions_mode', 'selinux_ctx', 'macro-start-delimiter',
+             'macro-end-delimiter', 'binary', 'target_path']
+# text files larger than this are sent base64 encoded
+large_file = 512 * 1024
 
-def do_update(channel_type, slave_configs, master_configs, m_client, m_session, s_client, s_session):
-    try:
-        for channel in uyunihub[channel_type]['configchannels']:
-            found = False
-            for config in slave_configs:
-                if channel == config.get('label'):
-                    for m_config in master_configs:
-                        if channel == m_config.get('label'):
-                            update_configchannel(config, m_config, m_client, m_session, s_client, s_session)
-                            found = True
-                            break
-            if not found:
-                log.info("Creating channel {}".format(channel))
-                cinfo = m_client.configchannel.getDetails(m_session, channel)
-                s_client.configchannel.create(s_session, cinfo.get('label'), cinfo.get('name'),
-                                              cinfo.get('description'), "state")
-                for m_config in master_configs:
-                    if channel == m_config.get('label'):
-                        create_configchannel(m_config, m_client, m_session, s_client, s_session)
-                        break
-    except:
-        log.info("no {} configchannels".format(channel_type))
 
+def load_manifest(hub_slave):
+    """
+    Return the manifest of the last run for this slave: {channel: {path: {'sha256': digest, 'meta': metadata}}}
+    """
+    if not os.path.isfile(manifest_name):
+        return {}
+    with open(manifest_name) as h_manifest:
+        manifest = yaml.safe_load(h_manifest) or {}
+    return manifest.get(hub_slave) or {}
 
-def sync_config(m_client, m_session, s_client, s_session, hub_slave):
-    try:
-        slave_configs = s_client.configchannel.listGlobals(s_session)
-    except xmlrpc.client.Fault as err:
-        log.warning("Unable to get a list of configuration channels on slave. Could be that there are none")
-        log.warning("Error:\n{}".format(err))
-    try:
-        master_configs = m_client.configchannel.listGlobals(m_session)
-    except xmlrpc.client.Fault as err:
-        log.warning("Unable to get a list of configuration channels on master. Could be that there are none. Aborting")
-        log.warning("Error:\n{}".format(err))
-        return
-    do_update('all', slave_configs, master_configs, m_client, m_session, s_client, s_session)
-    do_update(hub_slave, slave_configs, master_configs, m_client, m_session, s_client, s_session)
+
+def save_manifest(hub_slave, slave_manifest):
+    manifest = {}
+    if os.path.isfile(manifest_name):
+        with open(manifest_name) as h_manifest:
+            manifest = yaml.safe_load(h_manifest) or {}
+    manifest[hub_slave] = slave_manifest
+    with open(manifest_name + ".new", "w") as h_manifest:
+        yaml.safe_dump(manifest, h_manifest, default_flow_style=False)
+    os.replace(manifest_name + ".new", manifest_name)
+
+
+def file_entry(fileinfo):
+    """
+    Return the digest and the metadata of a file as returned by configchannel.lookupFileInfo
+    """
+    digest = fileinfo.get('sha256')
+    if not digest:
+        contents = fileinfo.get('contents') or ''
+        if fileinfo.get('contents_enc64'):
+            digest = hashlib.sha256(base64.b64decode(contents)).hexdigest()
+        else:
+            digest = hashlib.sha256(contents.encode('utf-8')).hexdigest()
+    meta = {}
+    for key in file_meta:
+        if fileinfo.get(key) is not None:
+            meta[key] = fileinfo.get(key)
+    return {'sha256': digest, 'meta': meta}
+
+
+def file_contents(fileinfo):
+    """
+    Return the contents for createOrUpdatePath. Contents already base64 encoded by the master are passed as they are,
+    binary and large files are sent base64 encoded.
+    """
+    contents = fileinfo.get('contents') or ''
+    if fileinfo.get('contents_enc64'):
+        return {'contents': contents, 'contents_enc64': True}
+    if fileinfo.get('binary') or len(contents) > large_file:
+        return {'contents': base64.b64encode(contents.encode('utf-8')).decode('ascii'), 'contents_enc64': True}
+    return {'contents': contents}
 
 
-def update_configchannel(s_channel, m_channel, m_client, m_session, s_client, s_session):
+def write_file(fileinfo, label, s_client, s_session):
+    path = fileinfo.get('path')
+    if fileinfo.get('type') == "sls":
+        s_client.configchannel.updateInitSls(s_session, label, file_contents(fileinfo))
+    elif fileinfo.get('type') == "symlink":
+        pathinfo = {'target_path': fileinfo.get('target_path')}
+        if fileinfo.get('selinux_ctx'):
+            pathinfo['selinux_ctx'] = fileinfo.get('selinux_ctx')
+        s_client.configchannel.createOrUpdateSymlink(s_session, label, path, pathinfo)
+    else:
+        is_dir = fileinfo.get('type') == "directory"
+        pathinfo = {'owner': fileinfo.get('owner', 'root'),
+                    'group': fileinfo.get('group', 'root'),
+                    'permissions': str(fileinfo.get('permissions_mode', '644')),
+                    'revision': fileinfo.get('revision')}
+        if fileinfo.get('selinux_ctx'):
+            pathinfo['selinux_ctx'] = fileinfo.get('selinux_ctx')
+        if not is_dir:
+            pathinfo['macro-start-delimiter'] = fileinfo.get('macro-start-delimiter', '{|')
+            pathinfo['macro-end-delimiter'] = fileinfo.get('macro-end-delimiter', '|}')
+            pathinfo['binary'] = bool(fileinfo.get('binary'))
+            pathinfo.update(file_contents(fileinfo))
+        s_client.configchannel.createOrUpdatePath(s_session, label, path, is_dir, pathinfo)
+
+
+def sync_channel(label, known, m_client, m_session, s_client, s_session):
+    """
+    Transfer the files of a configuration channel whose digest or metadata differ from the last run.
+    Returns the manifest entries of the channel and whether all files were synced.
+    """
     try:
-        m_files = m_client.configchannel.listFiles(m_session, m_channel.get('label'))
+        m_files = m_client.configchannel.listFiles(m_session, label)
     except xmlrpc.client.Fault as err:
-        log.warning(
-            "Unable to get a list of configuration files for channel {} on master".format(m_channel.get('label')))
+        log.warning("Unable to get a list of configuration files for channel {} on master".format(label))
         log.warning("Error:\n{}".format(err))
-        return
+        return known, False
     try:
-        s_files = s_client.configchannel.listFiles(s_session, s_channel.get('label'))
+        s_paths = [s_file.get('path') for s_file in s_client.configchannel.listFiles(s_session, label)]
     except xmlrpc.client.Fault as err:
-        log.warning(
-            "Unable to get a list of configuration files for channel {} on slave".format(s_channel.get('label')))
+        log.warning("Unable to get a list of configuration files for channel {} on slave".format(label))
         log.warning("Error:\n{}".format(err))
-    for m_file in m_files:
-        found = False
-        for s_file in s_files:
-            if m_file.get('path') == s_file.get('path'):
-                try:
-                    m_fileinfo = m_client.configchannel.lookupFileInfo(m_session, m_channel.get('label'), [m_file.get('path')])
-                except xmlrpc.client.Fault as err:
-                    log.warning("Unable to receive fileinfo from file on master: {}".format(m_file.get('path')))
-                    log.warning("Error:\n{}".format(err))
-                try:
-                    s_fileinfo = s_client.configchannel.lookupFileInfo(s_session, s_channel.get('label'), [s_file.get('path')])
-                except xmlrpc.client.Fault as err:
-                    log.warning("Unable to receive fileinfo from file on master: {}".format(m_file.get('path')))
-                    log.warning("Error:\n{}".format(err))
-                for x in m_fileinfo:
-                    for y in s_fileinfo:
-                        if y.get('revision') == x.get('revision'):
-                            log.info("Up-to-data file:  {}".format(m_file.get('path')))
-                            break
-                        else:
-                            log.info("Updating file:  {} to revision {}".format(m_file.get('path'), x.get('revision')))
-                            if m_file.get('type') == "sls":
-                                try:
-                                    s_client.configchannel.updateInitSls(s_session, s_channel.get('label'), {'contents': x.get('contents')})
-                                except xmlrpc.client.Fault as err:
-                                    log.warning("Unable to create file: init.sls")
-                                    log.warning("Error:\n{}".format(err))
-                            else:
-                                try:
-                                    s_client.configchannel.createOrUpdatePath(s_session, s_channel.get('label'),
-                                                                              x.get('path'), False,
-                                                                              {'revision': x.get('revision'),
-                                                                               'contents': x.get('contents'),
-                                                                               'owner': 'root', 'group': 'root',
-                                                                               'permissions': '644',
-                                                                               'macro-start-delimiter': '{|',
-                                                                               'macro-end-delimiter': '|}',
-                                                                               'binary': False})
-                                except xmlrpc.client.Fault as err:
-                                    log.warning("Unable to create file: {}".format(m_file.get('path')))
-                                    log.warning("Error:\n{}".format(err))
-                found = True
-                break
-        if not found:
-            try:
-                m_fileinfo = m_client.configchannel.lookupFileInfo(m_session, m_channel.get('label'),
-                                                                   [m_file.get('path')])
-            except xmlrpc.client.Fault as err:
-                log.warning("Unable to receive fileinfo from file on master: {}".format(m_file.get('path')))
-                log.warning("Error:\n{}".format(err))
-            if m_file.get('type') == "sls":
-                try:
-                    s_client.configchannel.updateInitSls(s_session, s_channel.get('label'),
-                                                         {'contents': m_fileinfo[0].get('contents')})
-                except xmlrpc.client.Fault as err:
-                    log.warning("Unable to create file: init.sls")
-                    log.warning("Error:\n{}".format(err))
-            else:
-                try:
-                    s_client.configchannel.createOrUpdatePath(s_session, s_channel.get('label'),
-                                                              m_file.get('path'), False,
-                                                              {'revision': m_fileinfo[0].get('revision'),
-                                                               'contents': m_fileinfo[0].get('contents'),
-                                                               'owner': 'root', 'group': 'root',
-                                                               'permissions': '644',
-                                                               'macro-start-delimiter': '{|',
-                                                               'macro-end-delimiter': '|}',
-                                                               'binary': False})
-                except xmlrpc.client.Fault as err:
-                    log.warning("Unable to create file: {}".format(m_file.get('path')))
-                    log.warning("Error:\n{}".format(err))
-
-
-def create_configchannel(m_channel, m_client, m_session, s_client, s_session):
+        s_paths = []
+    m_paths = [m_file.get('path') for m_file in m_files]
+    if not m_paths:
+        return {}, True
     try:
-        m_files = m_client.configchannel.listFiles(m_session, m_channel.get('label'))
+        m_fileinfo = m_client.configchannel.lookupFileInfo(m_session, label, m_paths)
     except xmlrpc.client.Fault as err:
-        log.warning("Unable to get a list of configuration files for channel {}".format(m_channel.get('label')))
+        log.warning("Unable to receive fileinfo from files of channel {} on master".format(label))
         log.warning("Error:\n{}".format(err))
-        return
-    for m_file in m_files:
+        return known, False
+    # files on the slave that are not in the manifest (first run) are compared with what the slave has
+    s_entries = {}
+    unknown = [path for path in m_paths if path in s_paths and path not in known]
+    if unknown:
         try:
-            m_fileinfo = m_client.configchannel.lookupFileInfo(m_session, m_channel.get('label'), [m_file.get('path')])
+            for fileinfo in s_client.configchannel.lookupFileInfo(s_session, label, unknown):
+                s_entries[fileinfo.get('path')] = file_entry(fileinfo)
         except xmlrpc.client.Fault as err:
-            log.warning("Unable to receive fileinfo from file: {}".format(m_file.get('path')))
+            log.warning("Unable to receive fileinfo from files of channel {} on slave".format(label))
             log.warning("Error:\n{}".format(err))
-        if m_file.get('type') == "sls":
-            log.info("Creating file: init.sls")
-            try:
-                s_client.configchannel.updateInitSls(s_session, m_channel.get('label'),
-                                                     {'contents': m_fileinfo[0].get('contents')})
-            except xmlrpc.client.Fault as err:
-                log.warning("Unable to create file: init.sls")
-                log.warning("Error:\n{}".format(err))
-        else:
-            log.info("Creating file: {}".format(m_file.get('path')))
-            print(m_fileinfo[0].get('revision'))
+    entries = {}
+    synced = True
+    for fileinfo in m_fileinfo:
+        path = fileinfo.get('path')
+        entry = file_entry(fileinfo)
+        if path in s_paths and entry == known.get(path, s_entries.get(path)):
+            log.info("Up-to-date file:  {}".format(path))
+            entries[path] = entry
+            continue
+        log.info("Updating file:  {} to revision {}".format(path, fileinfo.get('revision')))
+        try:
+            write_file(fileinfo, label, s_client, s_session)
+        except xmlrpc.client.Fault as err:
+            log.warning("Unable to create file: {}".format(path))
+            log.warning("Error:\n{}".format(err))
+            synced = False
+            continue
+        entries[path] = entry
+    return entries, synced
+
+
+def do_update(channel_type, slave_configs, master_configs, manifest, m_client, m_session, s_client, s_session):
+    try:
+        channels = uyunihub[channel_type]['configchannels'] or []
+    except (KeyError, TypeError):
+        log.info("no {} configchannels".format(channel_type))
+        return
+    s_labels = [config.get('label') for config in slave_configs]
+    m_labels = [config.get('label') for config in master_configs]
+    for channel in channels:
+        if channel not in m_labels:
+            log.warning("Configuration channel {} does not exist on master".format(channel))
+            continue
+        if channel not in s_labels:
+            log.info("Creating channel {}".format(channel))
             try:
-                s_client.configchannel.createOrUpdatePath(s_session, m_channel.get('label'), m_file.get('path'), False,
-                                                          {'revision': m_fileinfo[0].get('revision'),
-                                                           'contents': m_fileinfo[0].get('contents'),
-                                                           'owner': 'root', 'group': 'root', 'permissions': '644',
-                                                           'macro-start-delimiter': '{|', 'macro-end-delimiter': '|}',
-                                                           'binary': False})
+                cinfo = m_client.configchannel.getDetails(m_session, channel)
+                s_client.configchannel.create(s_session, cinfo.get('label'), cinfo.get('name'),
+                                              cinfo.get('description'), "state")
             except xmlrpc.client.Fault as err:
-                log.warning("Unable to create file: {}".format(m_file.get('path')))
+                log.warning("Unable to create channel {}".format(channel))
                 log.warning("Error:\n{}".format(err))
+                continue
+            s_labels.append(channel)
+            manifest.pop(channel, None)
+        entries, synced = sync_channel(channel, manifest.get(channel, {}), m_client, m_session, s_client, s_session)
+        manifest[channel] = entries
+        if not synced:
+            log.warning("Not all files of channel {} are synced. They will be retried on the next run".format(channel))
+
+
+def sync_config(m_client, m_session, s_client, s_session, hub_slave):
+    slave_configs = []
+    try:
+        slave_configs = s_client.configchannel.listGlobals(s_session)
+    except xmlrpc.client.Fault as err:
+        log.warning("Unable to get a list of configuration channels on slave. Could be that there are none")
+        log.warning("Error:\n{}".format(err))
+    try:
+        master_configs = m_client.configchannel.listGlobals(m_session)
+    except xmlrpc.client.Fault as err:
+        log.warning("Unable to get a list of configuration channels on master. Could be that there are none. Aborting")
+        log.warning("Error:\n{}".format(err))
+        return
+    manifest = load_manifest(hub_slave)
+    do_update('all', slave_configs, master_configs, manifest, m_client, m_session, s_client, s_session)
+    do_update(hub_slave, slave_configs, master_configs, manifest, m_client, m_session, s_client, s_session)
+    save_manifest(hub_slave, manifest)
 
 
 def main():
@@ -9,62 +9,58 @@ Primary usecase is a PTF update of existing saltboot initrd
 
 Script backups original initrd and link this backup to the original image.
 Once initrd is updates, script automatically updates checksum and size in the image pillar.
+
+RPM payloads are decoded in-process, in parallel, and their files are appended to the initrd
+as one zstd compressed newc archive. When several RPMs contain the same file, the RPM given last wins.
+
+With --all-matching the archive is built once and appended to the initrd of every matching image in parallel.
+Images failing to update are restored from their backup, other images are not affected.
 """
 
+import bz2
+import gzip
+import lzma
+import stat as st
+import struct
+import zlib
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from hashlib import md5
+from io import BytesIO
 from pprint import pprint
-from shutil import copy2
-from os import path, stat, rename, remove
+from fcntl import ioctl
+from shutil import copystat
+from os import path, stat, rename, remove, lseek, SEEK_SET
 from random import randint
-from requests import get, post
-from subprocess import call
-from tempfile import mkdtemp
+from fnmatch import fnmatch
+from osimage_api import login, getQuery, postQuery, printTimings
+from subprocess import run
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+# errors of a corrupt or truncated rpm
+EXTRACT_ERRORS = (OSError, ValueError, EOFError, lzma.LZMAError, zlib.error, struct.error)
+if zstandard:
+  EXTRACT_ERRORS += (zstandard.ZstdError,)
 
 OSIMAGEDIR = "/srv/www/os-images/1"
-SSLVERIFY = "/srv/www/htdocs/pub/RHN-ORG-TRUSTED-SSL-CERT"
-
-### API
-def login(user, password):
-  data = {"login": user, "password": password}
-  res = post(MANAGER_URL + 'auth/login', json=data, verify=SSLVERIFY)
-  if res.status_code != 200 or not res.json()['success']:
-    print(f"Failed to login with message: {res.json()['messages']}")
-    exit(1)
-  return res.cookies
-
-def getQuery(query, queryData=None, fatal=True):
-  queryParams = ""
-  if queryData:
-    queryParams = "?"
-    for key, value in queryData.items():
-      queryParams += f"{key}={value}&"
-  res = get(MANAGER_URL + query + queryParams, cookies=cookies, verify=SSLVERIFY)
-  if res.status_code != 200:
-    if fatal:
-      print(f"GET request {query} failed with error {res}")
-      exit(1)
-    else:
-      return None
-  elif not res.json()['success']:
-    if fatal:
-      print(f"GET request {query} failed with error {res.json()}")
-      exit(1)
-    else:
-      return None
-  return res.json()['result']
-
-def postQuery(query, queryData):
-  res = post(MANAGER_URL + query, json=queryData, cookies=cookies, verify=SSLVERIFY)
-  if res.status_code != 200:
-    print(f"POST request {query} failed with error {res}")
-    exit(1)
-  elif not res.json()['success']:
-    print(f"POST request {query} failed with error {res.json()}")
-    exit(1)
-  return res.json()['result']
-### API
+# ioctl to share the data blocks of a file (reflink) on btrfs, xfs and others
+FICLONE = 0x40049409
+
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+RPM_STRING_TYPE = 6
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+CPIO_TRAILER = 'TRAILER!!!'
+NEWC_FIELDS = ('ino', 'mode', 'uid', 'gid', 'nlink', 'mtime', 'filesize',
+               'devmajor', 'devminor', 'rdevmajor', 'rdevminor', 'namesize', 'check')
+
 
 def getImageDetails(name, version, revision):
   images = getQuery('image/listImages')
@@ -72,9 +68,9 @@ def getImageDetails(name, version, revision):
   if len(images) == 0:
     print(f"Unable to find image with name {name}, version {version} and revision {revision}")
     exit(2)
-  else:
-    image_data = images[0]
+  return getImageFiles(images[0])
 
+def getImageFiles(image_data):
   pillar_data = getQuery('image/getPillar', {'imageId': image_data['id']}, False)
 
   files_data = getQuery('image/getDetails', {'imageId': image_data['id']}).get('files', {})
@@ -100,11 +96,33 @@ def sanityCheck(initrd_path, rpm_path):
     print(f"Provided rpm path does not exists")
     exit(4)
 
+def cloneFile(src, dst):
+  """
+  Create dst with the contents of src, as reflink when the filesystem supports it.
+  Returns md5 object of the contents, computed in the same pass as the copy.
+  """
+  hash_obj = md5()
+  with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+    try:
+      ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+      cloned = True
+    except OSError:
+      cloned = False
+    for chunk in iter(lambda: src_fh.read(1024 * 1024), b""):
+      hash_obj.update(chunk)
+      if not cloned:
+        dst_fh.write(chunk)
+  copystat(src, dst)
+  return hash_obj
+
 def backupInitrd(initrd_path, imageId):
+  """
+  Returns backup name and md5 object of the original initrd
+  """
   r_suffix = str(randint(0, 9999))
   backup_name = f"{initrd_path}.{r_suffix}"
   rename(initrd_path, backup_name)
-  copy2(backup_name, initrd_path)
+  hash_obj = cloneFile(backup_name, initrd_path)
   
   query = {
     'imageId':  imageId,
@@ -114,7 +132,7 @@ def backupInitrd(initrd_path, imageId):
   }
   postQuery('image/addImageFile', query)
   print(f"Old initrd backed up as {backup_name}")
-  return backup_name
+  return backup_name, hash_obj
 
 def restoreBackup(backup_path, initrd, imageId):
   try:
@@ -131,67 +149,264 @@ def restoreBackup(backup_path, initrd, imageId):
   print(f"Original initrd restored, backup deleted")
 
 
-def modifyInitrd(initrd, rpm, image_id):
-  backup_name = backupInitrd(initrd, image_id)
-
+### RPM
+def readExact(stream, size):
+  data = bytearray()
+  while len(data) < size:
+    chunk = stream.read(size - len(data))
+    if not chunk:
+      raise ValueError("Unexpected end of RPM file")
+    data += chunk
+  return bytes(data)
+
+def pad4(size):
+  return (4 - size % 4) % 4
+
+def readRpmHeader(fh, aligned):
+  """
+  Read RPM header structure from fh and return its string tags
+  """
+  intro = readExact(fh, 16)
+  if intro[:4] != RPM_HEADER_MAGIC:
+    raise ValueError("Invalid RPM header")
+  nindex, hsize = struct.unpack('>II', intro[8:16])
+  index = readExact(fh, 16 * nindex)
+  store = readExact(fh, hsize)
+  if aligned:
+    # signature header is padded to 8 bytes
+    readExact(fh, (8 - hsize % 8) % 8)
+  tags = {}
+  for i in range(nindex):
+    tag, tag_type, offset, _ = struct.unpack('>IIII', index[i * 16:(i + 1) * 16])
+    if tag_type == RPM_STRING_TYPE:
+      tags[tag] = store[offset:store.index(b'\0', offset)].decode()
+  return tags
+
+def openPayload(fh):
+  """
+  Skip RPM lead and headers and return decompressed stream of the cpio payload
+  """
+  if readExact(fh, RPM_LEAD_SIZE)[:4] != RPM_LEAD_MAGIC:
+    raise ValueError("Not an RPM file")
+  readRpmHeader(fh, True)
+  tags = readRpmHeader(fh, False)
+  if tags.get(RPMTAG_PAYLOADFORMAT, 'cpio') != 'cpio':
+    raise ValueError(f"Unsupported payload format {tags[RPMTAG_PAYLOADFORMAT]}")
+  compressor = tags.get(RPMTAG_PAYLOADCOMPRESSOR, 'gzip')
+  if compressor == 'gzip':
+    return gzip.GzipFile(fileobj=fh)
+  elif compressor == 'bzip2':
+    return bz2.BZ2File(fh)
+  elif compressor in ('xz', 'lzma'):
+    return lzma.LZMAFile(fh)
+  elif compressor == 'zstd':
+    if zstandard:
+      return zstandard.ZstdDecompressor().stream_reader(fh)
+    lseek(fh.fileno(), fh.tell(), SEEK_SET)
+    res = run(['zstd', '-dc'], stdin=fh.fileno(), capture_output=True)
+    if res.returncode != 0:
+      raise ValueError("zstd failed to decompress the payload")
+    return BytesIO(res.stdout)
+  raise ValueError(f"Unsupported payload compressor {compressor}")
+
+def readCpio(stream):
+  """
+  Read cpio newc archive and return list of [name, fields, data]. Hardlinks are resolved to separate files.
+  """
+  entries = []
+  links = {}
+  while True:
+    header = readExact(stream, 110)
+    if header[:6] not in (b'070701', b'070702'):
+      raise ValueError(f"Unsupported cpio format {header[:6]}")
+    fields = dict(zip(NEWC_FIELDS, (int(header[6 + i * 8:14 + i * 8], 16) for i in range(len(NEWC_FIELDS)))))
+    name = readExact(stream, fields['namesize'])[:-1].decode()
+    readExact(stream, pad4(110 + fields['namesize']))
+    data = readExact(stream, fields['filesize'])
+    readExact(stream, pad4(fields['filesize']))
+    if name == CPIO_TRAILER:
+      break
+    while name.startswith('./'):
+      name = name[2:]
+    name = name.lstrip('/')
+    if name in ('', '.'):
+      continue
+    if fields['nlink'] > 1 and st.S_ISREG(fields['mode']):
+      links.setdefault((fields['devmajor'], fields['devminor'], fields['ino']), []).append(len(entries))
+    entries.append([name, fields, data])
+  # only the last hardlink of a file carries the data
+  for indexes in links.values():
+    data = next((entries[i][2] for i in reversed(indexes) if entries[i][2]), b'')
+    for i in indexes:
+      entries[i][2] = data
+  return entries
+
+def extractRpm(rpm):
+  print(f"Extracting RPM {rpm}")
+  with open(rpm, 'rb') as fh:
+    return readCpio(openPayload(fh))
+
+def newcEntry(ino, name, fields, data):
+  name = name.encode() + b'\0'
+  values = dict(fields, ino=ino, nlink=2 if st.S_ISDIR(fields['mode']) else 1,
+                filesize=len(data), namesize=len(name), check=0)
+  header = b'070701' + b''.join(b'%08X' % values[f] for f in NEWC_FIELDS)
+  return header + name + b'\0' * pad4(110 + len(name)) + data + b'\0' * pad4(len(data))
+
+def writeNewc(files, write):
+  """
+  Write files {name: (fields, data)} as newc archive. Parent directories missing in the files are added.
+  """
+  written = set()
+  ino = 0
+  dir_fields = dict.fromkeys(NEWC_FIELDS, 0)
+  dir_fields['mode'] = st.S_IFDIR | 0o755
+  for name in sorted(files):
+    parts = name.split('/')
+    for i in range(1, len(parts)):
+      parent = '/'.join(parts[:i])
+      if parent not in written and parent not in files:
+        ino += 1
+        write(newcEntry(ino, parent, dir_fields, b''))
+        written.add(parent)
+    ino += 1
+    fields, data = files[name]
+    write(newcEntry(ino, name, fields, data))
+    written.add(name)
+  write(newcEntry(0, CPIO_TRAILER, dict.fromkeys(NEWC_FIELDS, 0), b''))
+
+def buildArchive(files):
+  """
+  Returns files as zstd compressed newc archive
+  """
+  parts = []
+  writeNewc(files, parts.append)
+  if zstandard:
+    return zstandard.ZstdCompressor().compress(b''.join(parts))
+  res = run(['zstd', '-q', '-c'], input=b''.join(parts), capture_output=True)
+  if res.returncode != 0:
+    raise OSError("zstd failed to compress the archive")
+  return res.stdout
+
+def appendArchive(initrd, archive, hash_obj):
+  """
+  Append archive to initrd. hash_obj is md5 of the current initrd contents and is updated with the archive.
+  Returns md5 and size of the updated initrd.
+  """
+  with open(initrd, 'ab') as initrd_fh:
+    size = initrd_fh.tell()
+    initrd_fh.write(archive)
+  hash_obj.update(archive)
+  return (hash_obj.hexdigest(), size + len(archive))
+### RPM
+
+def extractRpms(rpm):
+  """
+  Returns compressed archive with the files of the rpm or all rpms in the directory
+  """
   todo = []
   if path.isfile(rpm):
     todo.append(rpm)
   elif path.isdir(rpm):
-    todo = glob(path.join(rpm, "*.rpm"))
+    todo = sorted(glob(path.join(rpm, "*.rpm")))
 
-  # extract all rpms to the work dir
-  workdir = mkdtemp()
-  failed = False
-  for f in todo:
-    print(f"Extracting RPM {f}")
-    try:
-      res = call(f"rpm2cpio {f} | cpio -idm", cwd=workdir, shell=True)
-      if res != 0:
-        failed = True
-        break
-    except:
-      failed = True
-
-  if failed:
-    print("Failed to extract rpm content, reverting to original")
-    restoreBackup(backup_name, initrd_path, image_id)
+  # decode all rpms in parallel, later rpms overwrite files of earlier ones
+  files = {}
+  try:
+    with ThreadPoolExecutor() as executor:
+      for entries in executor.map(extractRpm, todo):
+        for name, fields, data in entries:
+          files[name] = (fields, data)
+    return buildArchive(files)
+  except EXTRACT_ERRORS as e:
+    print(f"Failed to extract rpm content: {e}")
     exit(5)
-    
-  print("Updating initrd with RPM files")
-  with open(initrd, "a") as initrd_fh:
-    res = call(f"find . | cpio -H newc -o | zstd", shell=True, cwd=workdir, stdout=initrd_fh)
-    if res != 0:
-      failed = True
-      
+
+def modifyInitrd(initrd, archive, image_id):
+  """
+  Returns md5 and size of the updated initrd or None if the initrd was reverted to original
+  """
+  backup_name, hash_obj = backupInitrd(initrd, image_id)
+
+  print(f"Updating initrd {initrd} with RPM files")
+  try:
+    checksum = appendArchive(initrd, archive, hash_obj)
+  except OSError as e:
+    print(f"Failed to append updated initrd: {e}, reverting to original")
+    restoreBackup(backup_name, initrd, image_id)
+    return None
+
+  print("Initrd updated")
+  return checksum
+
+def updateImage(image_data, archive):
+  """
+  Update initrd and pillar of one image, used by --all-matching. Image is reverted to original if anything fails.
+  Returns False on failure, the failure of one image does not stop the others.
+  """
+  imagename = f"{image_data['name']}-{image_data['version']}-{image_data['revision']}"
+  try:
+    image_id, initrd, _, pillar_data = getImageFiles(image_data)
+    if not path.isfile(initrd):
+      print(f"Expected initrd file '{initrd}' does not exists")
+      return False
+    if not hasInitrdPillar(pillar_data, imagename):
+      print(f"Pillar of image {imagename} has no initrd checksum, image not updated")
+      return False
+    backup_name, hash_obj = backupInitrd(initrd, image_id)
+  except (Exception, SystemExit) as e:
+    print(f"Failed to update image {imagename}: {e}")
+    return False
+  try:
+    checksum = appendArchive(initrd, archive, hash_obj)
+    updateChecksums(initrd, pillar_data, image_id, imagename, checksum)
+  except (Exception, SystemExit) as e:
+    print(f"Failed to update image {imagename}: {e}, reverting to original")
+    try:
+      restoreBackup(backup_name, initrd, image_id)
+    except (Exception, SystemExit):
+      print(f"Failed to revert image {imagename}, backup is {backup_name}")
+    return False
+  print(f"Updated image {imagename}")
+  return True
+
+def updateImages(pattern, rpm, jobs):
+  images = getQuery('image/listImages')
+  images = list(filter(lambda image: fnmatch(f"{image['name']}-{image['version']}-{image['revision']}", pattern), images))
+  if len(images) == 0:
+    print(f"Unable to find images matching {pattern}")
+    exit(2)
+  archive = extractRpms(rpm)
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    results = list(executor.map(lambda image: updateImage(image, archive), images))
+  failed = results.count(False)
+  print(f"Updated {len(results) - failed} images, {failed} failed")
   if failed:
-    print("Failed to append updated initrd, reverting to original")
-    restoreBackup(backup_name, initrd_path, image_id)
     exit(5)
-  
-  print("Initrd updated")
-  
+
 def get_md5(initrd):
   if not path.isfile(initrd):
-    return res
+    return (None, None)
 
-  h = None
-  s = None
   with open(initrd, 'rb') as src:
     hash_obj = md5()
     # read the file in parts, not the entire file
-    for chunk in iter(lambda: src.read(65536), b""):
+    for chunk in iter(lambda: src.read(1024 * 1024), b""):
       hash_obj.update(chunk)
-      h = hash_obj.hexdigest()
-      s = stat(initrd).st_size
-  return (h, s)
+  return (hash_obj.hexdigest(), stat(initrd).st_size)
 
-def updateChecksums(initrd, pillar_data, imageId, imagename):
-  md5_hash, size = get_md5(initrd)
+def updateChecksums(initrd, pillar_data, imageId, imagename, checksum=None):
+  md5_hash, size = checksum or get_md5(initrd)
   pillar_data['boot_images'][imagename]['initrd']['hash'] = md5_hash
   pillar_data['boot_images'][imagename]['initrd']['size'] = size
   postQuery('image/setPillar', {'imageId': imageId, 'pillarData': pillar_data})
 
+def hasInitrdPillar(pillar_data, imagename):
+  try:
+    return 'initrd' in pillar_data['boot_images'][imagename]
+  except (TypeError, KeyError):
+    return False
+
 def findBackupFile(backup, backup_initrds):
   backup_name = path.basename(backup)
   found = {v for v in backup_initrds if path.basename(v) == backup_name}
@@ -222,14 +437,18 @@ if __name__ == "__main__":
   parser.add_argument('--host', help='SUSE Manager/Uyuni server to connect to', required=True)
   parser.add_argument('--api-user', default='admin', help='API user')
   parser.add_argument('--api-pass', default='admin', help='API password')
+  parser.add_argument('--timings', default=False, help='Print time spent per API endpoint', action='store_true')
 
   parser.add_argument('--rpm', help='Path the the RPM or directory with RPMs to source changes from.')
   parser.add_argument('--revert', default=None, help='Revert to backup initrd. Argument specify backup filename or path to the backup file')
   parser.add_argument('--clear', default=False, help='Clear all backups', action='store_true')
 
-  parser.add_argument('name', help='Name of the image to modify.')
-  parser.add_argument('version', help='Version of the image to modify.')
-  parser.add_argument('revision', help='Revision of the image to modify.')
+  parser.add_argument('--all-matching', metavar='PATTERN', help='Update all images whose <name>-<version>-<revision> match the glob with --rpm')
+  parser.add_argument('--jobs', type=int, default=4, help='Number of images updated in parallel with --all-matching')
+
+  parser.add_argument('name', nargs='?', help='Name of the image to modify.')
+  parser.add_argument('version', nargs='?', help='Version of the image to modify.')
+  parser.add_argument('revision', nargs='?', help='Revision of the image to modify.')
 
   args = parser.parse_args()
   
@@ -237,12 +456,29 @@ if __name__ == "__main__":
     print("Missing path to the RPM or directory with RPM files")
     exit(1)
 
-  MANAGER_URL=f"https://{args.host}/rhn/manager/api/"
+  if args.all_matching is None and args.revision is None:
+    print("Missing name, version and revision of the image")
+    exit(1)
+
   MANAGER_HOST=args.host
-  cookies = login(args.api_user, args.api_pass)
+  login(args.host, args.api_user, args.api_pass)
+
+  if args.all_matching:
+    if args.rpm is None:
+      print("--all-matching can only be used with --rpm")
+      exit(1)
+    if not (path.isfile(args.rpm) or path.isdir(args.rpm)):
+      print(f"Provided rpm path does not exists")
+      exit(4)
+    updateImages(args.all_matching, args.rpm, args.jobs)
+    if args.timings:
+      printTimings()
+    print("All done")
+    exit(0)
 
   image_id, initrd_path, backup_initrds, pillar_data = getImageDetails(args.name, args.version, args.revision)
 
+  checksum = None
   if args.revert:
     backup_file = findBackupFile(args.revert, backup_initrds)
     if backup_file is None:
@@ -253,10 +489,14 @@ if __name__ == "__main__":
     removeAllBackups(backup_initrds, image_id)
   elif args.rpm:
     sanityCheck(initrd_path, args.rpm)
-    modifyInitrd(initrd_path, args.rpm, image_id)
+    checksum = modifyInitrd(initrd_path, extractRpms(args.rpm), image_id)
+    if checksum is None:
+      exit(5)
   else:
     print("No action specified [--rpm|--revert|--clear]")
     exit(1)
   
-  updateChecksums(initrd_path, pillar_data, image_id, f"{args.name}-{args.version}-{args.revision}")
+  updateChecksums(initrd_path, pillar_data, image_id, f"{args.name}-{args.version}-{args.revision}", checksum)
+  if args.timings:
+    printTimings()
   print("All done")
@@ -3,7 +3,7 @@
 """
 This script helps with transfering images between two SUSE Manager/Uyuni servers.
 
-Script does not copy or move any files, only helps with exporting and importing image metadata.
+By default script does not copy or move any files, only helps with exporting and importing image metadata.
 
 Workflow:
 
@@ -11,56 +11,28 @@ Workflow:
 2) Transfer image files from one server to another, see `files` section of the exported metadata
 3) Call script with `import` option on the target server to import image metadata
 
+With `--with-files` the image files are exported to a bundle directory together with a manifest of their sizes and
+checksums. Import with `--with-files` copies them back to the image directory, verifies them against the manifest and
+the image pillar and only then imports the image metadata. Copies are done in chunks by parallel workers and
+an interrupted copy is resumed, chunks already present at the destination are not written again.
+
 Script takes care of URL mandling between different servers if required (for example for PXE images)
 """
 
 import argparse
+import hashlib
 import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from pprint import pprint
-import requests
-
-SSLVERIFY = "/srv/www/htdocs/pub/RHN-ORG-TRUSTED-SSL-CERT"
-
-### API
-def login(user, password):
-  data = {"login": user, "password": password}
-  res = requests.post(MANAGER_URL + 'auth/login', json=data, verify=SSLVERIFY)
-  if res.status_code != 200 or not res.json()['success']:
-    print(f"Failed to login with message: {res.json()['messages']}")
-    exit(1)
-  return res.cookies
-
-def getQuery(query, queryData=None, fatal=True):
-  queryParams = ""
-  if queryData:
-    queryParams = "?"
-    for key, value in queryData.items():
-      queryParams += f"{key}={value}&"
-  res = requests.get(MANAGER_URL + query + queryParams, cookies=cookies, verify=SSLVERIFY)
-  if res.status_code != 200:
-    if fatal:
-      print(f"GET request {query} failed with error {res}")
-      exit(1)
-    else:
-      return None
-  elif not res.json()['success']:
-    if fatal:
-      print(f"GET request {query} failed with error {res.json()}")
-      exit(1)
-    else:
-      return None
-  return res.json()['result']
-
-def postQuery(query, queryData):
-  res = requests.post(MANAGER_URL + query, json=queryData, cookies=cookies, verify=SSLVERIFY)
-  if res.status_code != 200:
-    print(f"POST request {query} failed with error {res}")
-    exit(1)
-  elif not res.json()['success']:
-    print(f"POST request {query} failed with error {res.json()}")
-    exit(1)
-  return res.json()['result']
-### API
+from osimage_api import login, getQuery, postQuery, printTimings
+
+OSIMAGEDIR = "/srv/www/os-images/1"
+CHUNK_SIZE = 16 * 1024 * 1024
+MANIFEST = "manifest.json"
+
 
 def mangle_pillar_data(pillar, what, to):
   for _, image in pillar['images'].items():
@@ -78,6 +50,123 @@ def mangle_pillar_data(pillar, what, to):
       sync.update({'kernel_url': sync['kernel_url'].replace(what, to)})
   return pillar
 
+### FILES
+def copyFile(src, dst, jobs):
+  """
+  Copy src to dst in chunks read and written by parallel workers. Chunks already present at the destination are
+  skipped. Returns size, checksums and chunk digests computed during the copy.
+  """
+  size = os.path.getsize(src)
+  os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+  md5_obj = hashlib.md5()
+  sha256_obj = hashlib.sha256()
+  chunks = []
+  resumed = 0
+  src_fd = os.open(src, os.O_RDONLY)
+  dst_fd = os.open(dst, os.O_RDWR | os.O_CREAT, 0o644)
+
+  def copyChunk(offset):
+    data = os.pread(src_fd, CHUNK_SIZE, offset)
+    digest = hashlib.sha256(data).hexdigest()
+    if hashlib.sha256(os.pread(dst_fd, len(data), offset)).hexdigest() == digest:
+      return data, digest, True
+    os.pwrite(dst_fd, data, offset)
+    return data, digest, False
+
+  try:
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+      offsets = iter(range(0, size, CHUNK_SIZE))
+      # keep a bounded window of chunks in flight, checksums are computed in file order
+      pending = deque(executor.submit(copyChunk, offset) for _, offset in zip(range(jobs * 2), offsets))
+      while pending:
+        data, digest, skipped = pending.popleft().result()
+        offset = next(offsets, None)
+        if offset is not None:
+          pending.append(executor.submit(copyChunk, offset))
+        md5_obj.update(data)
+        sha256_obj.update(data)
+        chunks.append(digest)
+        resumed += skipped
+    os.ftruncate(dst_fd, size)
+  finally:
+    os.close(src_fd)
+    os.close(dst_fd)
+  if resumed:
+    print(f"Copied {dst}, {resumed} of {len(chunks)} chunks were already present")
+  else:
+    print(f"Copied {dst}")
+  return {'size': size, 'md5': md5_obj.hexdigest(), 'sha256': sha256_obj.hexdigest(), 'chunks': chunks}
+
+def pillar_checksums(pillar):
+  """
+  Returns {filename: (md5, size)} of all files described in the image pillar
+  """
+  res = {}
+  if not pillar:
+    return res
+  for _, image in pillar.get('boot_images', {}).items():
+    for kind in ('initrd', 'kernel'):
+      if image.get(kind, {}).get('filename'):
+        res[image[kind]['filename']] = (image[kind].get('hash'), image[kind].get('size'))
+  for _, image in pillar.get('images', {}).items():
+    for _, version in image.items():
+      if version.get('filename'):
+        res[version['filename']] = (version.get('hash'), version.get('size'))
+  return res
+
+def verifyFile(name, copied, expected, pillar_sums):
+  ok = True
+  if expected and (copied['size'] != expected['size'] or copied['sha256'] != expected['sha256']):
+    print(f"File {name} does not match the bundle manifest")
+    ok = False
+  pillar_hash, pillar_size = pillar_sums.get(os.path.basename(name), (None, None))
+  if pillar_size is not None and int(pillar_size) != copied['size']:
+    print(f"File {name} has size {copied['size']}, image pillar expects {pillar_size}")
+    ok = False
+  if pillar_hash and pillar_hash != copied['md5']:
+    print(f"File {name} has md5 {copied['md5']}, image pillar expects {pillar_hash}")
+    ok = False
+  return ok
+
+def exportFiles(files, pillar, bundle, image_dir, jobs):
+  """
+  Copy image files to the bundle, returns their manifest entries
+  """
+  entries = {}
+  pillar_sums = pillar_checksums(pillar)
+  for f in files:
+    if f.get('external'):
+      continue
+    copied = copyFile(os.path.join(image_dir, f['file']), os.path.join(bundle, f['file']), jobs)
+    if not verifyFile(f['file'], copied, None, pillar_sums):
+      exit(4)
+    entries[f['file']] = copied
+  return entries
+
+def writeManifest(bundle, entries):
+  with open(os.path.join(bundle, MANIFEST), 'w') as out_fh:
+    json.dump({'chunk_size': CHUNK_SIZE, 'files': entries}, out_fh, indent=2)
+
+def importFiles(files, pillar, bundle, image_dir, jobs):
+  """
+  Copy image files from the bundle, returns False if a file is missing or does not match
+  """
+  with open(os.path.join(bundle, MANIFEST), 'r') as fh:
+    manifest = json.load(fh)
+  pillar_sums = pillar_checksums(pillar)
+  for f in files:
+    if f.get('external'):
+      continue
+    expected = manifest['files'].get(f['file'])
+    if expected is None:
+      print(f"File {f['file']} is missing in the bundle manifest")
+      return False
+    copied = copyFile(os.path.join(bundle, f['file']), os.path.join(image_dir, f['file']), jobs)
+    if not verifyFile(f['file'], copied, expected, pillar_sums):
+      return False
+  return True
+### FILES
+
 ### EXPORT
 def filter_files_data(files):
   res = []
@@ -89,17 +178,13 @@ def filter_files_data(files):
 def filter_image_data(image):
   return {k:v for k, v in image.items() if k == 'name' or k == 'version' or k == 'arch'}
 
-def exportImage(name, version, revision, output):
-  images = getQuery('image/listImages')
-  print(f"Exporting image {name}, version {version}, revision {revision}")
-  images = list(filter(lambda image: (image['name'] == name and image['version'] == version and image['revision'] == int(revision)), images))
-  if len(images) == 0:
-    print(f"Unable to find image with name {name}, version {version} and revision {revision}")
-    exit(2)
-  elif len(images) == 1:
-    image_data = images[0]
-  else:
-    pass
+def findImages(images, name, version, revision):
+  return list(filter(lambda image: (image['name'] == name and image['version'] == version and image['revision'] == int(revision)), images))
+
+def filterImages(images, pattern):
+  return list(filter(lambda image: fnmatch(f"{image['name']}-{image['version']}-{image['revision']}", pattern), images))
+
+def collectImage(image_data):
   pillar_data = getQuery('image/getPillar', {'imageId': image_data['id']}, False)
   if pillar_data:
     pillar_data = mangle_pillar_data(pillar_data, MANAGER_HOST, '{{HOST}}')
@@ -107,68 +192,183 @@ def exportImage(name, version, revision, output):
   files_data = getQuery('image/getDetails', {'imageId': image_data['id']}).get('files', {})
   files_data = filter_files_data(files_data)
 
-  result = {
+  return {
     'image': filter_image_data(image_data),
     'files': files_data,
     'pillar': pillar_data
   }
+
+def exportImage(name, version, revision, output, bundle=None, image_dir=OSIMAGEDIR, jobs=4):
+  images = getQuery('image/listImages')
+  print(f"Exporting image {name}, version {version}, revision {revision}")
+  images = findImages(images, name, version, revision)
+  if len(images) == 0:
+    print(f"Unable to find image with name {name}, version {version} and revision {revision}")
+    exit(2)
+  image_data = images[0]
+  result = collectImage(image_data)
+  if bundle:
+    os.makedirs(bundle, exist_ok=True)
+    writeManifest(bundle, exportFiles(result['files'], result['pillar'], bundle, image_dir, jobs))
+    if not output:
+      output = os.path.join(bundle, 'image.json')
   if output:
     with open(output, 'w') as out_fh:
       json.dump(result, out_fh, indent=2)
   else:
     pprint(result)
+
+def exportImages(pattern, output, bundle=None, image_dir=OSIMAGEDIR, jobs=4):
+  """
+  Export all images matching pattern as JSON Lines, one image per line.
+  Image list is fetched once, pillar and details of the images are fetched in parallel.
+  """
+  images = filterImages(getQuery('image/listImages'), pattern)
+  if len(images) == 0:
+    print(f"Unable to find images matching {pattern}")
+    exit(2)
+  print(f"Exporting {len(images)} images")
+  if bundle:
+    os.makedirs(bundle, exist_ok=True)
+    if not output:
+      output = os.path.join(bundle, 'images.jsonl')
+  entries = {}
+  out_fh = open(output, 'w') if output else None
+  try:
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+      for result in executor.map(collectImage, images):
+        image = result['image']
+        print(f"Exported image {image['name']}, version {image['version']}")
+        if bundle:
+          entries.update(exportFiles(result['files'], result['pillar'], bundle, image_dir, jobs))
+        if out_fh:
+          out_fh.write(json.dumps(result) + "\n")
+        else:
+          pprint(result)
+  finally:
+    if out_fh:
+      out_fh.close()
+  if bundle:
+    writeManifest(bundle, entries)
 ### EXPORT
 
 ### IMPORT
-def importImage(file):
+def importImage(file, bundle=None, image_dir=OSIMAGEDIR, jobs=4):
     print(f"Importing image data from {file}")
     image_data = None
     with open(file, 'r') as fh:
       image_data = json.load(fh)
+    error = importImageData(image_data, file, bundle, image_dir, jobs)
+    if error:
+      exit(error)
+
+def importImageData(image_data, file, bundle=None, image_dir=OSIMAGEDIR, jobs=4):
+    """
+    Returns 0 on success, otherwise the exit code of the failure
+    """
+    if bundle and not importFiles(image_data['files'], image_data['pillar'], bundle, image_dir, jobs):
+      return 4
 
-    imageId = int(postQuery('image/importOSImage', image_data['image']))
+    imageId = postQuery('image/importOSImage', image_data['image'], False)
     if not imageId:
       print(f"Failed to get imageId for imported image from file {file}")
-      exit(3)
+      return 3
+    imageId = int(imageId)
     new_pillar = mangle_pillar_data(image_data['pillar'], '{{HOST}}', MANAGER_HOST)
-    postQuery('image/setPillar', {'imageId': imageId, 'pillarData': new_pillar})
+    if postQuery('image/setPillar', {'imageId': imageId, 'pillarData': new_pillar}, False) is None:
+      return 3
     for f in image_data['files']:
       f['imageId'] = imageId
-      postQuery('image/addImageFile', f)
+      if postQuery('image/addImageFile', f, False) is None:
+        return 3
+    return 0
+
+def importImages(file, bundle=None, image_dir=OSIMAGEDIR, jobs=4):
+    """
+    Import all images of a JSON Lines export, images are imported in parallel
+    """
+    print(f"Importing images from {file}")
+
+    def importOne(image_data):
+      image = image_data['image']
+      try:
+        error = importImageData(image_data, file, bundle, image_dir, 1)
+      except Exception as e:
+        print(f"Failed to import image {image['name']}, version {image['version']}: {e}")
+        return False
+      if error:
+        print(f"Failed to import image {image['name']}, version {image['version']}")
+        return False
+      print(f"Imported image {image['name']}, version {image['version']}")
+      return True
+
+    with open(file, 'r') as fh:
+      with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(importOne, (json.loads(line) for line in fh if line.strip())))
+    failed = results.count(False)
+    print(f"Imported {len(results) - failed} images, {failed} failed")
+    if failed:
+      exit(3)
 
 ### IMPORT
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
     description='Uyuni/SUSE Manager OS images metadata import/export tool',
-    epilog='Script should be run on SUSE Manager server and does not copy any image files!')
+    epilog='Script should be run on SUSE Manager server and does not copy any image files unless --with-files is used!')
 
   parser.add_argument('--host', help='SUSE Manager/Uyuni server to connect to', required=True)
   parser.add_argument('--api-user', default='admin', help='API user')
   parser.add_argument('--api-pass', default='admin', help='API password')
+  parser.add_argument('--timings', default=False, help='Print time spent per API endpoint', action='store_true')
+  parser.add_argument('--image-dir', default=OSIMAGEDIR, help=f'Directory with the image files, default {OSIMAGEDIR}')
+  parser.add_argument('--jobs', type=int, default=4, help='Number of parallel workers copying image files or processing images')
 
   subparsers = parser.add_subparsers()
   export_parser = subparsers.add_parser('export', help='Image export mode')
-  export_parser.add_argument('name', help='Name of the image to export')
-  export_parser.add_argument('version', help='Version of the image to export without revision.')
-  export_parser.add_argument('revision', help='Revision of the image to export.')
+  export_parser.add_argument('name', nargs='?', help='Name of the image to export')
+  export_parser.add_argument('version', nargs='?', help='Version of the image to export without revision.')
+  export_parser.add_argument('revision', nargs='?', help='Revision of the image to export.')
+  export_parser.add_argument('--all', action='store_true', help='Export all images as JSON Lines')
+  export_parser.add_argument('--filter', help='Export all images whose <name>-<version>-<revision> match the glob as JSON Lines')
   export_parser.add_argument('--outfile', help='Store result to file instead of using standard output', required=False)
+  export_parser.add_argument('--with-files', action='store_true', help='Also export the image files to the bundle directory')
+  export_parser.add_argument('--bundle', help='Bundle directory for --with-files, default <name>-<version>-<revision>. Image data is stored as image.json in the bundle unless --outfile is used')
   export_parser.set_defaults(mode='export')
 
   import_parser = subparsers.add_parser('import', help='Image import mode')
-  import_parser.add_argument('filename', help='Filename with image data to be imported')
+  import_parser.add_argument('filename', help='Filename with image data to be imported, files ending with .jsonl are imported as multiple images')
+  import_parser.add_argument('--with-files', action='store_true', help='Also import the image files from the bundle directory')
+  import_parser.add_argument('--bundle', help='Bundle directory for --with-files, default is the directory of filename')
   import_parser.set_defaults(mode='import')
 
   args = parser.parse_args()
+  if args.mode == 'export' and not (args.all or args.filter) and args.revision is None:
+    export_parser.error("name, version and revision are required unless --all or --filter is used")
 
-  MANAGER_URL=f"https://{args.host}/rhn/manager/api/"
   MANAGER_HOST=args.host
-  cookies = login(args.api_user, args.api_pass)
+  login(args.host, args.api_user, args.api_pass)
 
   if args.mode == 'export':
-    exportImage(args.name, args.version, args.revision, args.outfile)
+    bundle = None
+    if args.all or args.filter:
+      if args.with_files:
+        bundle = args.bundle or "images"
+      exportImages(args.filter or '*', args.outfile, bundle, args.image_dir, args.jobs)
+    else:
+      if args.with_files:
+        bundle = args.bundle or f"{args.name}-{args.version}-{args.revision}"
+      exportImage(args.name, args.version, args.revision, args.outfile, bundle, args.image_dir, args.jobs)
   elif args.mode == 'import':
-    importImage(args.filename)
+    bundle = None
+    if args.with_files:
+      bundle = args.bundle or os.path.dirname(os.path.abspath(args.filename))
+    if args.filename.endswith('.jsonl'):
+      importImages(args.filename, bundle, args.image_dir, args.jobs)
+    else:
+      importImage(args.filename, bundle, args.image_dir, args.jobs)
 
+  if args.timings:
+    printTimings()
 
   print("All done")
@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: 2023 SUSE LLC
+#
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""
+Shared Uyuni/SUSE Manager REST API helpers of the OS image tools.
+
+All calls go through one keep-alive requests.Session with a connection pool large enough for
+parallel workers. Query parameters are URL encoded by requests. GET requests are retried with backoff
+on 5xx responses and connection resets, all requests are retried when the connection can not be established.
+Time spent per endpoint is collected and can be printed with printTimings().
+"""
+
+from threading import Lock
+from time import monotonic
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SSLVERIFY = "/srv/www/htdocs/pub/RHN-ORG-TRUSTED-SSL-CERT"
+POOL_SIZE = 16
+RETRIES = Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+
+MANAGER_URL = None
+session = Session()
+session.verify = SSLVERIFY
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=RETRIES))
+
+timings = {}
+timings_lock = Lock()
+
+def timed(query, method, **kwargs):
+  start = monotonic()
+  res = method(MANAGER_URL + query, **kwargs)
+  elapsed = monotonic() - start
+  with timings_lock:
+    count, total = timings.get(query, (0, 0.0))
+    timings[query] = (count + 1, total + elapsed)
+  return res
+
+def printTimings():
+  print("Endpoint                                  calls     total   average")
+  for query, (count, total) in sorted(timings.items(), key=lambda t: t[1][1], reverse=True):
+    print(f"{query:40} {count:6d} {total:8.2f}s {total / count:8.3f}s")
+
+def login(host, user, password):
+  global MANAGER_URL
+  MANAGER_URL = f"https://{host}/rhn/manager/api/"
+  data = {"login": user, "password": password}
+  res = timed('auth/login', session.post, json=data)
+  if res.status_code != 200 or not res.json()['success']:
+    print(f"Failed to login with message: {res.json()['messages']}")
+    exit(1)
+  return res.cookies
+
+def getQuery(query, queryData=None, fatal=True):
+  res = timed(query, session.get, params=queryData)
+  if res.status_code != 200:
+    if fatal:
+      print(f"GET request {query} failed with error {res}")
+      exit(1)
+    else:
+      return None
+  elif not res.json()['success']:
+    if fatal:
+      print(f"GET request {query} failed with error {res.json()}")
+      exit(1)
+    else:
+      return None
+  return res.json()['result']
+
+def postQuery(query, queryData, fatal=True):
+  res = timed(query, session.post, json=queryData)
+  if res.status_code != 200:
+    print(f"POST request {query} failed with error {res}")
+    if fatal:
+      exit(1)
+    return None
+  elif not res.json()['success']:
+    print(f"POST request {query} failed with error {res.json()}")
+    if fatal:
+      exit(1)
+    return None
+  return res.json()['result']
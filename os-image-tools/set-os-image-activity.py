@@ -1,51 +1,85 @@
 #!/usr/bin/env python3
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from pprint import pprint
-import requests
-
-SSLVERIFY = "/srv/www/htdocs/pub/RHN-ORG-TRUSTED-SSL-CERT"
-
-### API
-def login(user, password):
-  data = {"login": user, "password": password}
-  res = requests.post(MANAGER_URL + 'auth/login', json=data, verify=SSLVERIFY)
-  if res.status_code != 200 or not res.json()['success']:
-    print(f"Failed to login with message: {res.json()['messages']}")
-    exit(1)
-  return res.cookies
-
-def getQuery(query, queryData=None, fatal=True):
-  queryParams = ""
-  if queryData:
-    queryParams = "?"
-    for key, value in queryData.items():
-      queryParams += f"{key}={value}&"
-  res = requests.get(MANAGER_URL + query + queryParams, cookies=cookies, verify=SSLVERIFY)
-  if res.status_code != 200:
-    if fatal:
-      print(f"GET request {query} failed with error {res}")
-      exit(1)
-    else:
-      return None
-  elif not res.json()['success']:
-    if fatal:
-      print(f"GET request {query} failed with error {res.json()}")
-      exit(1)
-    else:
-      return None
-  return res.json()['result']
-
-def postQuery(query, queryData):
-  res = requests.post(MANAGER_URL + query, json=queryData, cookies=cookies, verify=SSLVERIFY)
-  if res.status_code != 200:
-    print(f"POST request {query} failed with error {res}")
-    exit(1)
-  elif not res.json()['success']:
-    print(f"POST request {query} failed with error {res.json()}")
-    exit(1)
-  return res.json()['result']
-### API
+from time import monotonic
+from osimage_api import login, getQuery, postQuery, printTimings
+
+def imageLabel(image):
+  return f"{image['name']}-{image['version']}-{image['revision']}"
+
+def getPillar(image):
+  return getQuery('image/getPillar', {'imageId': image['id']}, False)
+
+def setPillar(change):
+  """
+  Returns True if the pillar of the image has been stored
+  """
+  image, pillar_data = change
+  return postQuery('image/setPillar', {'imageId': image['id'], 'pillarData': pillar_data}, False) is not None
+
+def planChanges(images, pillars, inactivity):
+  """
+  Returns [(image, pillar)] of images whose inactive flag differs from the requested one.
+  Images without pillar are skipped, images whose pillar could not be fetched are not in pillars.
+  """
+  plan = []
+  for image in images:
+    if image['id'] not in pillars:
+      continue
+    pillar_data = pillars[image['id']]
+    if not pillar_data or not pillar_data.get('images'):
+      print(f"Skipping image {imageLabel(image)} without pillar")
+      continue
+    changed = False
+    for _, version_dict in pillar_data['images'].items():
+      for _, image_details in version_dict.items():
+        if image_details.get('inactive', False) != inactivity:
+          image_details['inactive'] = inactivity
+          changed = True
+    if changed:
+      plan.append((image, pillar_data))
+  return plan
+
+def setActivityAll(pattern, inactivity, jobs, dry_run):
+  """
+  Set activity of all images matching pattern. Image list is fetched once, pillars are fetched and
+  changed pillars are stored by parallel workers. Images already in the requested state are not touched.
+  Returns the images which failed to fetch or store their pillar.
+  """
+  start = monotonic()
+  images = list(filter(lambda image: fnmatch(imageLabel(image), pattern), getQuery('image/listImages')))
+  if len(images) == 0:
+    print(f"Unable to find images matching {pattern}")
+    exit(2)
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    pillars = {}
+    failed = []
+    for image, pillar_data in zip(images, executor.map(getPillar, images)):
+      if pillar_data is None:
+        print(f"Failed to fetch pillar of image {imageLabel(image)}")
+        failed.append(image)
+      else:
+        pillars[image['id']] = pillar_data
+    fetched = monotonic()
+    plan = planChanges(images, pillars, inactivity)
+    state = 'inactive' if inactivity else 'active'
+    for image, _ in plan:
+      print(f"{'Would set' if dry_run else 'Setting'} image {imageLabel(image)} {state}")
+    if not dry_run:
+      for (image, _), ok in zip(plan, executor.map(setPillar, plan)):
+        if not ok:
+          print(f"Failed to set image {imageLabel(image)} {state}")
+          failed.append(image)
+  print(f"{len(images)} images matched, {len(plan)} to change, {len(pillars) - len(plan)} unchanged, "
+        f"{len(images) - len(pillars)} failed to fetch")
+  print(f"Fetching took {fetched - start:.2f}s, applying took {monotonic() - fetched:.2f}s")
+  if failed:
+    print(f"{len(failed)} images failed: {', '.join(imageLabel(image) for image in failed)}")
+  return failed
+
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
@@ -55,29 +89,43 @@ if __name__ == "__main__":
   parser.add_argument('--host', help='SUSE Manager/Uyuni server to connect to', required=True)
   parser.add_argument('--api-user', default='admin', help='API user')
   parser.add_argument('--api-pass', default='admin', help='API password')
+  parser.add_argument('--timings', default=False, help='Print time spent per API endpoint', action='store_true')
 
   parser.add_argument('mode', choices=['set-active', 'set-inactive'], help='Set image active or inactive')
 
-  parser.add_argument('name', help='Name of the image to change')
-  parser.add_argument('version', help='Version of the image to change without revision')
-  parser.add_argument('revision', help='Revision of the image to change')
+  parser.add_argument('name', nargs='?', help='Name of the image to change')
+  parser.add_argument('version', nargs='?', help='Version of the image to change without revision')
+  parser.add_argument('revision', nargs='?', help='Revision of the image to change')
+
+  parser.add_argument('--all-matching', metavar='PATTERN', help='Change all images whose <name>-<version>-<revision> match the glob')
+  parser.add_argument('--jobs', type=int, default=8, help='Number of parallel API calls with --all-matching')
+  parser.add_argument('--dry-run', default=False, help='Only print the planned changes of --all-matching', action='store_true')
 
   args = parser.parse_args()
+  if args.all_matching is None and args.revision is None:
+    parser.error("name, version and revision are required unless --all-matching is used")
 
-  MANAGER_URL=f"https://{args.host}/rhn/manager/api/"
   MANAGER_HOST=args.host
-  cookies = login(args.api_user, args.api_pass)
+  login(args.host, args.api_user, args.api_pass)
 
   inactivity = True
   if args.mode == 'set-active':
     inactivity = False
 
+  if args.all_matching:
+    failed = setActivityAll(args.all_matching, inactivity, args.jobs, args.dry_run)
+    if args.timings or args.dry_run:
+      printTimings()
+    if failed:
+      exit(3)
+    print("All done")
+    exit(0)
 
   images = getQuery('image/listImages')
   print(f"Modifying image {args.name}, version {args.version}, revision {args.revision}")
   images = list(filter(lambda image: (image['name'] == args.name and image['version'] == args.version and image['revision'] == int(args.revision)), images))
   if len(images) == 0:
-    print(f"Unable to find image with name {name}, version {version} and revision {revision}")
+    print(f"Unable to find image with name {args.name}, version {args.version} and revision {args.revision}")
     exit(2)
   elif len(images) == 1:
     image_data = images[0]
@@ -92,4 +140,7 @@ if __name__ == "__main__":
 
   postQuery('image/setPillar', {'imageId': image_data['id'], 'pillarData': pillar_data}) 
 
+  if args.timings:
+    printTimings()
+
   print("All done")
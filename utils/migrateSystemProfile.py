@@ -12,6 +12,9 @@ Author: Pradeep Kilambi <pkilambi@redhat.com>
 import csv
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 try:
     import xmlrpclib
 except ImportError:
@@ -25,6 +28,8 @@ if _topdir not in sys.path:
     sys.path.append(_topdir)
 
 client = None
+satellite_url = None
+thread_clients = threading.local()
 DEBUG = 0
 
 options_table = [
@@ -42,12 +47,18 @@ options_table = [
            help="Destination Org ID"),
     Option("--csv",                action="store",
            help="CSV File to process"),
+    Option("--chunk-size",         action="store", type="int", default=100,
+           help="Number of systems migrated with one call (default 100)"),
+    Option("--jobs",               action="store", type="int", default=4,
+           help="Number of calls running at the same time (default 4)"),
+    Option("--retry-csv",          action="store",
+           help="CSV File receiving the systems that failed to migrate (default <csv>.retry)"),
 ]
 
 _csv_fields = ['systemId', 'to-org-id']
 
 def main():
-    global client, DEBUG
+    global client, satellite_url, DEBUG
     parser = OptionParser(option_list=options_table)
 
     (options, _args) = parser.parse_args()
@@ -66,10 +77,9 @@ def main():
 
     client = xmlrpclib.Server(satellite_url, verbose=0)
 
-    if options.csv:
-        migrate_data = read_csv_file(options.csv)
-    else:
-        migrate_data = []
+    if options.chunk_size < 1 or options.jobs < 1:
+        print("--chunk-size and --jobs must be at least 1")
+        return 1
 
     if not options.csv:
         if not options.systemId:
@@ -89,19 +99,20 @@ def main():
 
     sessionKey = xmlrpc_login(client, username, password)
 
-    if not migrate_data:
-        sys.stderr.write("Nothing to migrate. Exiting.. \n")
-        sys.exit(1)
+    if options.csv:
+        retry_csv = options.retry_csv or options.csv + ".retry"
+        failed = migrate_csv(sessionKey, options.csv, retry_csv,
+                             options.chunk_size, options.jobs)
+        xmlrpc_logout(client, sessionKey)
+        return 1 if failed else None
 
     for server_id, to_org_id in migrate_data:
         if isinstance(server_id, type([])):
             server_id = list(map(int, server_id))
         else:
             server_id = [int(server_id)]
-        try:
-            migrate_system(sessionKey, int(to_org_id), server_id)
-        except Exception:  # pylint: disable=try-except-raise
-            raise
+        if not migrate_system(sessionKey, int(to_org_id), server_id):
+            sys.exit(-1)
 
     if DEBUG:
         print("Migration Completed successfully")
@@ -109,17 +120,91 @@ def main():
 
     return None
 
+def get_client():
+    """
+    xmlrpc connections can not be shared between threads, every thread gets its own
+    """
+    if not hasattr(thread_clients, 'client'):
+        thread_clients.client = xmlrpclib.Server(satellite_url, verbose=0)
+    return thread_clients.client
+
+
 def migrate_system(key, newOrgId, server_ids):
     """
-    Call to migrate given system to new org
+    Call to migrate given system to new org, returns False when the migration failed
     """
     if DEBUG:
         print("Migrating systemIds %s to Org %s" % (server_ids, newOrgId))
     try:
-        client.org.migrateSystems(key, newOrgId, server_ids)
+        get_client().org.migrateSystems(key, newOrgId, server_ids)
     except xmlrpclib.Fault as e:
         sys.stderr.write("Error: %s\n" % e.faultString)
-        sys.exit(-1)
+        return False
+    return True
+
+
+def migrate_csv(key, csv_file, retry_csv, chunk_size, jobs):
+    """
+    Migrate the systems of the csv file in chunks per destination org. Chunks are
+    started while the file is read. Systems that failed to migrate are written to
+    retry_csv. At most jobs * 2 chunks are queued at the same time. Returns the
+    number of failed systems.
+    """
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(jobs * 2)
+    counts = {'migrated': 0, 'failed': 0}
+    f_retry = open(retry_csv, 'w')
+    retry_writer = csv.writer(f_retry)
+
+    def migrate_chunk(to_org_id, server_ids):
+        try:
+            ok = migrate_system(key, to_org_id, server_ids)
+        except Exception as e:
+            sys.stderr.write("Error: migrating systemIds %s failed: %s\n" % (server_ids, e))
+            ok = False
+        finally:
+            slots.release()
+        with lock:
+            if ok:
+                counts['migrated'] += len(server_ids)
+            else:
+                counts['failed'] += len(server_ids)
+                for server_id in server_ids:
+                    retry_writer.writerow([server_id, to_org_id])
+
+    def submit(to_org_id, server_ids):
+        slots.acquire()
+        executor.submit(migrate_chunk, to_org_id, server_ids)
+
+    start = time.time()
+    pending = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for server_id, to_org_id in read_csv_file(csv_file):
+            try:
+                server_id, to_org_id = int(server_id), int(to_org_id)
+            except ValueError:
+                sys.stderr.write("Invalid Data %s. Skipping line .. \n" % [server_id, to_org_id])
+                continue
+            chunk = pending.setdefault(to_org_id, [])
+            chunk.append(server_id)
+            if len(chunk) >= chunk_size:
+                submit(to_org_id, pending.pop(to_org_id))
+        for to_org_id, chunk in pending.items():
+            submit(to_org_id, chunk)
+    f_retry.close()
+
+    elapsed = time.time() - start
+    total = counts['migrated'] + counts['failed']
+    if not counts['failed']:
+        os.remove(retry_csv)
+    if not total:
+        sys.stderr.write("Nothing to migrate. Exiting.. \n")
+        sys.exit(1)
+    print("Migrated %d systems, %d failed in %.1f seconds (%.1f systems/s)"
+          % (counts['migrated'], counts['failed'], elapsed, total / max(elapsed, 0.001)))
+    if counts['failed']:
+        print("Systems that failed to migrate are written to %s" % retry_csv)
+    return counts['failed']
 
 
 
@@ -144,18 +229,16 @@ def lookup_server(key, from_org_id):
 
 def read_csv_file(csv_file):
     """
-     Parse the fields in the given csv
+     Parse the fields in the given csv, rows are returned while the file is read
     """
-    csv_data = []
-    f_csv = open(csv_file)
-    reader = csv.reader(f_csv)
-    for data in reader:
-        if len(data) != len(_csv_fields):
-            sys.stderr.write("Invalid Data.Skipping line .. \n"
-                             % data)
-            continue
-        csv_data.append(data)
-    return csv_data
+    with open(csv_file) as f_csv:
+        reader = csv.reader(f_csv)
+        for data in reader:
+            if len(data) != len(_csv_fields):
+                sys.stderr.write("Invalid Data %s. Skipping line .. \n"
+                                 % data)
+                continue
+            yield data
 
 if __name__ == '__main__':
     sys.exit(main() or 0)
@@ -6,7 +6,7 @@
 # GNU Public License. No warranty. No Support
 # For question/suggestions/bugs mail: michael.brookhuis@suse.com
 #
-# Version: 2025-08-14
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis
 #
@@ -16,15 +16,77 @@
 #
 # Releases:
 # 2025-08-14 M.Brookhuis - Initial release
+# 2026-10-19 - Profiles are matched against the system names with an Aho-Corasick automaton, profiles are
+#              deleted in parallel. Added --dryrun and --jobs.
 #
 
 """
 This script will delete profiles from which a system has been installed.
 """
 
+import argparse
+import threading
+import xmlrpc.client
+from argparse import RawTextHelpFormatter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import smtools
 
 __smt = None
+connections = threading.local()
+
+
+class ProfileMatcher:
+    """
+    Aho-Corasick automaton over the profile labels. All profiles contained in a system name are found with
+    one pass over the name, independent of the number of profiles.
+    """
+
+    def __init__(self, profiles):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for profile in profiles:
+            node = 0
+            for char in profile:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.out[node].append(profile)
+        # breadth first, so the fail link of a node is complete before its children are handled
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text):
+        """
+        Returns the profiles contained in the text.
+
+        :param text: the text to search in, eg. a system name
+        :type text: str
+        :return: the profile labels found in the text
+        :rtype: set
+        """
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            found.update(self.out[node])
+        return found
+
 
 def get_profiles():
     """
@@ -41,34 +103,73 @@ def get_profiles():
 
 def get_systems():
     """
-    Generates and returns a list of system names from the system list.
+    Generates and returns a list of systems from the system list.
 
     This function retrieves information about systems via the `smt.system_listsystems`
-    method, extracts the 'name' field from each system, and compiles it into a list.
+    method and returns the 'name' and 'id' field of each system.
 
-    :return: A list of system names
+    :return: A list of tuples with system name and system id
     :rtype: list
     """
-    return [c.get('name') for c in smt.system_listsystems()]
+    return [(c.get('name'), c.get('id')) for c in smt.system_listsystems()]
 
-def start_cleanup_profiles():
+def get_client():
+    """
+    Returns the connection to SUSE Manager of the current thread.
+    """
+    if not hasattr(connections, 'client'):
+        connections.client = smt.suman_connect()
+    return connections.client
+
+def delete_profile(profile):
+    """
+    Deletes a kickstart profile. Errors are reported, but don't stop the cleanup.
+
+    :param profile: The label of the profile to delete.
+    :type profile: str
+    :return: True if the profile has been deleted.
+    :rtype: bool
+    """
+    try:
+        get_client().kickstart.deleteProfile(smt.session, profile)
+    except (xmlrpc.client.Fault, OSError, xmlrpc.client.ProtocolError) as err:
+        smt.log_debug('api-call: kickstart.deleteProfile')
+        smt.log_debug(f'  label:    {profile}')
+        smt.log_debug(f"Error: \n{err}")
+        smt.minor_error(f'Unable to delete profile for {profile}')
+        return False
+    return True
+
+def start_cleanup_profiles(dryrun=False, jobs=4):
     """
     Starts the cleanup process for profiles by checking their existence in systems
-    and deleting them if necessary. It identifies relevant profiles by matching
-    them with available systems and performs deletions using specific methods.
+    and deleting them if necessary. All system names are scanned once for all profile
+    labels, the system id is taken from the same system listing. The profiles are
+    deleted with at most jobs deletions at the same time.
 
-    :raises Exception: If an unexpected error occurs during the cleanup process.
+    :param dryrun: Only report the profiles that would be deleted.
+    :type dryrun: bool
+    :param jobs: Number of profiles deleted at the same time.
+    :type jobs: int
+    :return: True if all profiles to be deleted have been deleted.
+    :rtype: bool
     """
     profiles = get_profiles()
-    systems = get_systems()
-    for profile in profiles:
-        result = [s for s in systems if profile in s]
-        if result:
-            sid = smt.get_server_id(False, result[0])
-            if sid != 0:
-                smt.log_info(f"Deleting profile {profile}")
-                smt.kickstart_deleteprofile(profile)
-    return
+    matcher = ProfileMatcher(profiles)
+    installed = {}
+    for name, sid in get_systems():
+        for profile in matcher.search(name):
+            installed.setdefault(profile, (name, sid))
+    to_delete = [profile for profile in profiles if profile in installed]
+    for profile in to_delete:
+        name, sid = installed[profile]
+        smt.log_info(f"{'DRYRUN: ' if dryrun else ''}Deleting profile {profile}, installed as {name} ({sid})")
+    if dryrun or not to_delete:
+        return True
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(delete_profile, to_delete))
+    smt.log_info(f"Deleted {results.count(True)} of {len(to_delete)} profiles")
+    return all(results)
 
 def main():
     """
@@ -86,14 +187,25 @@ def main():
     """
     global smt
     smt = smtools.SMTools("cleanup_profiles")
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=('''\
+         Usage:
+         cleanup_profiles.py
+
+         This script will delete the profiles from which a system has been installed.
+               '''))
+    parser.add_argument("-n", "--dryrun", action="store_true", default=0,
+                        help="Only show the profiles that would be deleted.")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of profiles deleted at the same time. Default 4")
+    args = parser.parse_args()
     smt.log_info("Start")
     smt.suman_login()
-    if start_cleanup_profiles():
-        smt.close_program()
+    if start_cleanup_profiles(args.dryrun, args.jobs):
         smt.log_info("Finished successfully")
+        smt.close_program()
     else:
-        smt.close_program(1)
         smt.log_error("Finished with errors")
+        smt.close_program(1)
 
 if __name__ == "__main__":
     SystemExit(main())
@@ -6,7 +6,7 @@
 # GNU Public License. No warranty. No Support
 # For question/suggestions/bugs mail: michael.brookhuis@suse.com
 #
-# Version: 2020-06-30
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis
 #
@@ -17,6 +17,8 @@
 # 2020-06-30 M.Brookhuis - Version 2.
 #                        - changed logging
 #                        - moved api calls to smtools.py
+# 2026-10-19 - Existing repositories, channels and keys are read once, repositories are created in parallel
+#              and the number of running synchronizations is limited.
 
 #
 """This program will create the needed channels and repositories"""
@@ -24,79 +26,146 @@
 import argparse
 from argparse import RawTextHelpFormatter
 import os
+import threading
+import time
 import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
 import smtools
 
 __smt = None
+connections = threading.local()
 
 
-def check_present(wanted, item_list):
+def get_client():
     """
-    check if item is present in the list
+    Connection to SUSE Manager of the current thread
     """
-    for item in item_list:
-        if item.get('description') == wanted:
-            return True
-    return False
+    if not hasattr(connections, 'client'):
+        connections.client = smt.suman_connect()
+    return connections.client
 
 
-def do_repo_config(repo_config, sync):
+def check_repo(repo, repo_info, all_crypto_keys, all_repos, all_channels):
     """
-    Evaluate the repo config
+    check if the repository and channel can be created
     """
-    all_crypto_keys = smt.kickstart_keys_listallkeys()
-    for repo, repo_info in repo_config['repository'].items():
-        # check if key, cert, ca exist
-        if repo_info['key']:
-            if not check_present(repo_info['key'], all_crypto_keys):
-                smt.minor_error("The given key {} for repository {} doesn't exist. Continue with next item.".format(repo_info['key'], repo))
-                continue
-        if repo_info['ca']:
-            if not check_present(repo_info['ca'], all_crypto_keys):
-                smt.minor_error(
-                    "The given ca {} for repository {} doesn't skip. Continue with next item.".format(repo_info['ca'], repo))
-                continue
-        if repo_info['cert']:
-            if not check_present(repo_info['cert'], all_crypto_keys):
-                smt.minor_error("The given key {} for repository {} doesn't skip. Continue with next item.".format(repo_info['cert'], repo))
-                continue
-        # check if repository exist
-        if smt.channel_software_getrepodetails(repo, True):
-            smt.minor_error("The repository {} already exists. Skipping to next".format(repo))
-            continue
-        else:
-            smt.log_info("Repository {} will be created if channel is not present".format(repo))
-        # check if channel exist
-        if smt.channel_software_getdetails(repo):
-            smt.minor_error("The channel {} already exists. Skipping to next".format(repo))
-            continue
-        else:
-            smt.log_info("Channel {} will be created if parent channel is present".format(repo))
-        # check if parent exist
-        if not smt.channel_software_getdetails(repo_info['parent']):
-            smt.minor_error("Parent channel not present. No repository {} or channel {} will be created".format(repo, repo))
-            continue
-        # create repo
+    # check if key, cert, ca exist
+    if repo_info['key'] and repo_info['key'] not in all_crypto_keys:
+        smt.minor_error("The given key {} for repository {} doesn't exist. Continue with next item.".format(repo_info['key'], repo))
+        return False
+    if repo_info['ca'] and repo_info['ca'] not in all_crypto_keys:
+        smt.minor_error(
+            "The given ca {} for repository {} doesn't skip. Continue with next item.".format(repo_info['ca'], repo))
+        return False
+    if repo_info['cert'] and repo_info['cert'] not in all_crypto_keys:
+        smt.minor_error("The given key {} for repository {} doesn't skip. Continue with next item.".format(repo_info['cert'], repo))
+        return False
+    # check if repository exist
+    if repo in all_repos:
+        smt.minor_error("The repository {} already exists. Skipping to next".format(repo))
+        return False
+    # check if channel exist
+    if repo in all_channels:
+        smt.minor_error("The channel {} already exists. Skipping to next".format(repo))
+        return False
+    # check if parent exist
+    if repo_info['parent'] not in all_channels:
+        smt.minor_error("Parent channel not present. No repository {} or channel {} will be created".format(repo, repo))
+        return False
+    smt.log_info("Repository and channel {} will be created".format(repo))
+    return True
+
+
+def create_repo(repo, repo_info):
+    """
+    Create the repository and channel and set the sync schedule
+    """
+    client = get_client()
+    step = 'channel.software.createRepo'
+    try:
         if repo_info['key']:
-            if not smt.channel_software_createrepo_cert(repo, repo_info['type'], repo_info['url'], repo_info['ca'], repo_info['cert'], repo_info['key'], True):
-                continue
+            client.channel.software.createRepo(smt.session, repo, repo_info['type'], repo_info['url'],
+                                               repo_info['ca'], repo_info['cert'], repo_info['key'])
         else:
-            if not smt.channel_software_createrepo(repo, repo_info['type'], repo_info['url'], True):
-                continue
-
-        # create channel
-        smt.channel_software_create(repo, repo, repo, "channel-x86_64", repo_info['parent'])
-        smt.channel_software_associaterepo(repo, repo)
-        smt.channel_software_syncrepo(repo, repo_info['schedule'])
-        if sync:
+            client.channel.software.createRepo(smt.session, repo, repo_info['type'], repo_info['url'])
+        step = 'channel.software.create'
+        client.channel.software.create(smt.session, repo, repo, repo, "channel-x86_64", repo_info['parent'])
+        step = 'channel.software.associateRepo'
+        client.channel.software.associateRepo(smt.session, repo, repo)
+        step = 'channel.software.syncRepo'
+        client.channel.software.syncRepo(smt.session, repo, repo_info['schedule'])
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: {}'.format(step))
+        smt.log_debug("Error: \n{}".format(err))
+        smt.minor_error("Unable to create repository and channel {}. Failed at {}".format(repo, step))
+        return False
+    smt.log_info("Repositoriy {} and Channel {} created".format(repo, repo))
+    return True
+
+
+def sync_finished(repo):
+    try:
+        return bool(smt.client.channel.software.getDetails(smt.session, repo).get('yumrepo_last_sync'))
+    except xmlrpc.client.Fault:
+        return False
+
+
+def sync_repos(repos, max_syncs, sync_timeout):
+    """
+    Start the initial synchronization of the repositories. At most max_syncs synchronizations are running at the
+    same time, the next one is started when a synchronization has finished.
+    """
+    try:
+        wait_time = smtools.CONFIGSM['maintenance']['wait_between_events_check']
+    except KeyError:
+        wait_time = 30
+    queue = list(repos)
+    running = {}
+    while queue or running:
+        while queue and len(running) < max_syncs:
+            repo = queue.pop(0)
             try:
                 smt.client.channel.software.syncRepo(smt.session, repo)
             except xmlrpc.client.Fault:
                 smt.log_error("Unable to sync repository {}".format(repo))
             else:
                 smt.log_info("Sync of repository {} started.".format(repo))
-        smt.log_info("Repositoriy {} and Channel {} created".format(repo, repo))
-        smt.log_info(" ")
+                running[repo] = time.monotonic()
+        if not running:
+            continue
+        time.sleep(wait_time)
+        for repo, started in list(running.items()):
+            if sync_finished(repo):
+                smt.log_info("Sync of repository {} finished in {:.0f} seconds.".format(repo, time.monotonic() - started))
+                del running[repo]
+            elif time.monotonic() - started > sync_timeout:
+                smt.log_warning("Sync of repository {} is still running after {} seconds. Starting the next sync.".format(repo, sync_timeout))
+                del running[repo]
+        smt.log_info("{} syncs running, {} waiting".format(len(running), len(queue)))
+
+
+def do_repo_config(repo_config, args):
+    """
+    Evaluate the repo config
+    """
+    start = time.monotonic()
+    all_crypto_keys = {key.get('description') for key in smt.kickstart_keys_listallkeys()}
+    try:
+        all_repos = {repo.get('label') for repo in smt.client.channel.software.listUserRepos(smt.session)}
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: channel.software.listUserRepos')
+        smt.log_debug("Error: \n{}".format(err))
+        smt.fatal_error("Unable to get a list of repositories")
+    all_channels = set(smt.get_labels_all_channels())
+    repos = {repo: repo_info for repo, repo_info in repo_config['repository'].items()
+             if check_repo(repo, repo_info, all_crypto_keys, all_repos, all_channels)}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda item: create_repo(*item), repos.items()))
+    created = [repo for repo, result in zip(repos, results) if result]
+    smt.log_info("{} of {} repositories created in {:.1f} seconds".format(len(created), len(repo_config['repository']),
+                                                                        time.monotonic() - start))
+    if args.sync and created:
+        sync_repos(created, args.max_syncs, args.sync_timeout)
 
 
 def main():
@@ -112,6 +181,12 @@ def main():
     parser.add_argument("-r", "--repos", help="file containing the reposotiries to be created")
     parser.add_argument("-s", '--sync', action="store_true", default=0,
                         help="Synchronizechannel after creation. Default off")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of repositories created at the same time. Default 4")
+    parser.add_argument("-m", "--max-syncs", type=int, default=2,
+                        help="Maximum number of synchronizations running at the same time. Default 2")
+    parser.add_argument("-t", "--sync-timeout", type=int, default=7200,
+                        help="Seconds after which a synchronization is no longer counted as running. Default 7200")
     parser.add_argument('--version', action='version', version='%(prog)s 2.0.0, June 30, 2020')
     args = parser.parse_args()
     if not args.repos:
@@ -127,7 +202,7 @@ def main():
             with open(args.repos) as repo_cfg:
                 repo_config = smtools.load_yaml(repo_cfg)
     smt.suman_login()
-    do_repo_config(repo_config, args.sync)
+    do_repo_config(repo_config, args)
     smt.close_program()
 
 
@@ -4,7 +4,7 @@
 # GNU Public License. No warranty. No Support
 # For question/suggestions/bugs mail: michael.brookhuis@suse.com
 #
-# Version: 2025-08-18
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis
 #
@@ -12,10 +12,12 @@
 #
 # Releases:
 # 2025-08-18 M.Brookhuis - initial release.
+# 2026-10-19 - Added --sync to make the group membership match the file.
 #
 
 import argparse
 import sys
+import xmlrpc.client
 from argparse import RawTextHelpFormatter
 
 import smtools
@@ -145,6 +147,91 @@ def export_group(group, file):
     return
 
 
+def read_names(file):
+    """
+    Read the system names from a file, 1 system per line. Empty lines are skipped.
+
+    :param file: The path to the file to be read.
+    :type file: str
+    :return: The system names in the file.
+    :rtype: set[str]
+    """
+    try:
+        with open(file, 'r') as sync_file:
+            return {line.strip() for line in sync_file if line.strip()}
+    except IOError:
+        smt.fatal_error(f"Can't open file {file} for reading")
+
+def get_members(group, create, dryrun):
+    """
+    Retrieves the members of a system group. When the group doesn't exist and create is
+    given, the group is created (or only reported when running with dryrun).
+
+    :param group: The name of the system group.
+    :type group: str
+    :param create: Create the system group when it doesn't exist.
+    :type create: bool
+    :param dryrun: Only report that the group would be created.
+    :type dryrun: bool
+    :return: dict with the system id and name of the members.
+    :rtype: dict[int, str]
+    """
+    try:
+        systems = smt.client.systemgroup.listSystemsMinimal(smt.session, group)
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: systemgroup.listSystemsMinimal')
+        smt.log_debug(f"Error: \n{err}")
+        if not create:
+            smt.fatal_error(f"Group {group} not found. Aborting operation")
+        if dryrun:
+            smt.log_info(f"DRYRUN: group {group} would be created")
+        else:
+            smt.systemgroup_create(group, group)
+        return {}
+    return {system.get('id'): system.get('name') for system in systems}
+
+def sync_group(args):
+    """
+    Makes the membership of the system group exactly match the systems in the file. The
+    current members are read with one call and the systems in the file are resolved against
+    one listing of all systems. Only the difference is added or removed, in chunks of
+    args.chunk systems. With args.dryrun the difference is only reported.
+
+    :param args: The given options.
+    :return: None
+    """
+    smt.log_debug("Start sync_group")
+    names = read_names(args.file)
+    members = get_members(args.group, args.create, args.dryrun)
+    ids = {}
+    for system in smt.system_listsystems():
+        ids.setdefault(system.get('name'), []).append(system.get('id'))
+    wanted = {}
+    for name in sorted(names):
+        if name not in ids:
+            smt.log_error(f"System {name} not found")
+        elif len(ids[name]) > 1:
+            smt.log_error(f"Duplicate system {name}. Please fix and run again.")
+        else:
+            wanted[ids[name][0]] = name
+    to_add = sorted(set(wanted) - set(members))
+    # members listed in the file but not resolved (duplicates) are kept
+    to_remove = sorted(sid for sid in set(members) - set(wanted) if members[sid] not in names)
+    prefix = "DRYRUN: " if args.dryrun else ""
+    for sid in to_add:
+        smt.log_info(f"{prefix}+ {wanted[sid]}")
+    for sid in to_remove:
+        smt.log_info(f"{prefix}- {members[sid]}")
+    smt.log_info(f"{prefix}{len(to_add)} systems to add, {len(to_remove)} systems to remove, "
+                 f"{len(set(wanted) & set(members))} systems unchanged")
+    if args.dryrun:
+        return
+    for i in range(0, len(to_add), args.chunk):
+        add_remove_systems(args.group, to_add[i:i + args.chunk], True)
+    for i in range(0, len(to_remove), args.chunk):
+        add_remove_systems(args.group, to_remove[i:i + args.chunk], False)
+    smt.log_debug("Finished sync_group")
+
 def start_sync(args):
     """
     Starts the synchronization process based on the provided arguments. The function performs
@@ -158,6 +245,9 @@ def start_sync(args):
     :return: None
     """
     smt.log_debug("Start sync")
+    if args.sync:
+        sync_group(args)
+        return
     if args.export:
         export_group(args.group, args.file)
         return
@@ -196,6 +286,19 @@ def check_arguments(args):
     if args.export and not args.file:
         smt.log_error("Option --file not given and is required when using --export. Aborting operation")
         sys.exit(1)
+    if args.sync:
+        if not args.file:
+            smt.log_error("Option --file not given and is required when using --sync. Aborting operation")
+            sys.exit(1)
+        if args.add or args.remove or args.overwrite or args.export or args.system:
+            smt.log_error("Option --sync can not be used with --add/--remove/--overwrite/--export/--system. "
+                          "Aborting operation")
+            sys.exit(1)
+        # the existence of the group is checked when reading its members
+        smt.log_debug("Finished check_arguments")
+        return
+    if args.dryrun:
+        smt.log_warning("Option --dryrun has only a function when using with --sync")
     if (args.add or args.overwrite) and args.export:
         smt.log_error("Option --add/--overwrite and --export can not be used together. Aborting operation")
         sys.exit(1)
@@ -233,6 +336,8 @@ def main():
          This script will either export the members of a system group to a file, or import the systems from a file 
          to a system group. When the option -c is given, the system group will be created is not existing during an 
          import.
+         With --sync the system group will contain exactly the systems in the file. Use --dryrun to only show the
+         differences.
                '''))
     parser.add_argument("-f", "--file",
                         help="File name of the file to export,add or remove.")
@@ -250,6 +355,12 @@ def main():
                         help="Create the system group if it doesn't exist by an import.")
     parser.add_argument("-o", "--overwrite", action="store_true", default=0,
                         help="On import, remove all that is currently present in system group.")
+    parser.add_argument("-y", "--sync", action="store_true", default=0,
+                        help="Add and remove systems so the system group contains exactly the systems in the file.")
+    parser.add_argument("-n", "--dryrun", action="store_true", default=0,
+                        help="With --sync, only show the systems that would be added or removed.")
+    parser.add_argument("--chunk", type=int, default=500,
+                        help="With --sync, number of systems added or removed per call. Default 500")
 
     parser.add_argument('--version', action='version', version='%(prog)s 1.0.0, August 18, 2025')
     args = parser.parse_args()
@@ -5,20 +5,27 @@ This script reactivates all clients which uses specified proxy FQDN as salt mast
 
 Workflow:
 
-1) use salt grains targeting to get the list of salt minion ids
-2) use XMLRPC API to generate reactivation for each salt client
-3) update susemanager.conf of the client to inject reactivation key
-4) restart salt minion
+1) use salt grains targeting to get the list of salt minion ids (one salt call)
+2) use XMLRPC API to get the connection path of the clients, in batches spread over parallel connections
+3) use XMLRPC API to generate reactivation for each salt client, in parallel
+4) update susemanager.conf of the clients to inject reactivation key, in salt batches
+5) restart salt minions as a salt batch job
 
 Restart of salt minion will trigger automatic reactivation of the client system
 which will update client's connection path in the database.
+
+The number of clients handled per second is printed for every stage, use --workers, --batch and
+--batch-wait to tune the load on the SUSE Manager server and the proxy.
 """
 
 import argparse
 import getpass
 import salt.client
 import sys
-from xmlrpc.client import ServerProxy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xmlrpc.client import ServerProxy, Fault
 
 parser = argparse.ArgumentParser(description = "Reactivate all online clients attached to the specified proxy (determined by salt clients 'master' grain)")
 parser.add_argument("--dryrun", default=False, action="store_true", help = "Show the actions, but do not do anything")
@@ -26,6 +33,11 @@ parser.add_argument("--limit", default=None, help = "Limit the number of modifie
 parser.add_argument("--host", help = "SUSE Manager hostname")
 parser.add_argument("--user", help = "SUSE Manager username for login. If not provided, will be asked for")
 parser.add_argument("--password", help = "SUSE Manager password for login. If not provided, will be asked for")
+parser.add_argument("--workers", default=8, type=int, help = "Number of parallel XMLRPC connections (default 8)")
+parser.add_argument("--chunk", default=50, type=int, help = "Number of connection paths fetched per XMLRPC worker task (default 50)")
+parser.add_argument("--batch", default=50, type=int, help = "Number of salt clients changed and restarted at the same time (default 50)")
+parser.add_argument("--batch-wait", default=0, type=int, help = "Seconds to wait between salt batches (default 0)")
+parser.add_argument("--timeout", default=30, type=int, help = "Seconds to wait for the salt clients of a batch to return (default 30)")
 parser.add_argument("proxy_fqdn", help = "FQDN or proxy which clients are to be reactivated")
 
 args = parser.parse_args()
@@ -49,23 +61,52 @@ if args.limit is not None:
 
 MANAGER_URL = "https://{}/rpc/api".format(args.host)
 
-if __name__ == "__main__":
-    suma_rpc = ServerProxy(MANAGER_URL)
-    key = suma_rpc.auth.login(args.user, args.password)
+rpc_pool = threading.local()
 
-    clients = []
-    nclients = 0
 
-    client_mapping = suma_rpc.system.getMinionIdMap(key)
-    suma_salt = salt.client.LocalClient()
-    res = suma_salt.cmd_iter("master:{}".format(args.proxy_fqdn), "grains.item", ["id", "saltpath"], tgt_type="grain", timeout = 2)
-    for c in res:
-        nclients += 1
-        if maxclients < nclients:
+def get_rpc():
+    """
+    ServerProxy objects can not be shared between threads, every worker gets its own connection.
+    """
+    if not hasattr(rpc_pool, "rpc"):
+        rpc_pool.rpc = ServerProxy(MANAGER_URL)
+    return rpc_pool.rpc
+
+
+class Stage:
+    """
+    Measure the throughput of one stage of the reactivation.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.monotonic()
+
+    def done(self, count):
+        elapsed = time.monotonic() - self.start
+        rate = count / elapsed if elapsed > 0 else 0
+        print('STATS: {}: {} clients in {:.1f}s ({:.1f} clients/s)'.format(self.name, count, elapsed, rate))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def collect_clients(suma_salt):
+    """
+    Get id and salt path of all clients connected to the proxy with a single salt call.
+    """
+    stage = Stage("collect grains")
+    res = suma_salt.cmd("master:{}".format(args.proxy_fqdn), "grains.item", ["id", "saltpath"], tgt_type="grain", timeout = 2)
+    clients = []
+    for minion, salt_ret in sorted(res.items()):
+        if len(clients) >= maxclients:
             break
-        
-        salt_ret = list(c.values())[0]["ret"]
-        c_saltid = salt_ret["id"]
+        if not isinstance(salt_ret, dict):
+            print('ERROR: Unable to get grains of salt client {}: {}'.format(minion, salt_ret))
+            continue
+        c_saltid = salt_ret.get("id", minion)
         c_configpath = "/etc/salt/minion.d/susemanager.conf"
         c_service = "salt-minion"
 
@@ -73,37 +114,141 @@ if __name__ == "__main__":
         if "venv" in salt_ret.get("saltpath", ""):
             c_configpath = "/etc/venv-salt-minion/minion.d/susemanager.conf"
             c_service = "venv-salt-minion"
+        clients.append((c_saltid, c_configpath, c_service))
+    stage.done(len(clients))
+    return clients
+
+
+def connected_to_proxy(key, chunk):
+    """
+    Return the server ids of the chunk which are already connected to the proxy.
+    """
+    rpc = get_rpc()
+    connected = set()
+    for c_id in chunk:
+        try:
+            rpc_ret = rpc.system.getConnectionPath(key, c_id)
+        except Fault as err:
+            print('ERROR: Unable to get connection path of server id {}: {}'.format(c_id, err.faultString))
+            continue
+        for path in rpc_ret:
+            if path.get('position') == 1 and path.get('hostname') == args.proxy_fqdn:
+                connected.add(c_id)
+    return connected
+
 
+def filter_connected(key, executor, clients, client_mapping):
+    """
+    Drop the clients which are unknown or already connected to the proxy.
+    """
+    stage = Stage("connection paths")
+    todo = []
+    for c_saltid, c_configpath, c_service in clients:
         print('Processing salt client {}'.format(c_saltid))
         c_id = client_mapping.get(c_saltid)
         if c_id is None:
             print('ERROR: Cannot find server id for salt client {}'.format(c_saltid))
             continue
-        # check if already assigned to correct proxy
-        skip = False
-        rpc_ret = suma_rpc.system.getConnectionPath(key, c_id)
-        for path in rpc_ret:
-            if path.get('position') == 1 and path.get('hostname') == args.proxy_fqdn:
-                print('INFO: Skipping client {}, already connected to correct proxy.'.format(c_saltid))
-                skip = True
-        if skip:
+        todo.append((c_saltid, c_id, c_configpath, c_service))
+    connected = set()
+    for result in executor.map(lambda chunk: connected_to_proxy(key, chunk), chunks([c[1] for c in todo], args.chunk)):
+        connected |= result
+    stage.done(len(todo))
+    for c_saltid, c_id, _, _ in todo:
+        if c_id in connected:
+            print('INFO: Skipping client {}, already connected to correct proxy.'.format(c_saltid))
+    return [c for c in todo if c[1] not in connected]
+
+
+def obtain_key(key, client):
+    c_saltid, c_id, c_configpath, c_service = client
+    if args.dryrun:
+        print('DRYRUN: suma_rpc.system.obtainReactivationKey(key, {})'.format(c_id))
+        return c_saltid, c_configpath, "reactivation key", c_service
+    try:
+        return c_saltid, c_configpath, get_rpc().system.obtainReactivationKey(key, c_id), c_service
+    except Fault as err:
+        print('ERROR: Unable to obtain reactivation key for salt client {}: {}'.format(c_saltid, err.faultString))
+        return None
+
+
+def obtain_keys(key, executor, clients):
+    stage = Stage("reactivation keys")
+    result = [c for c in executor.map(lambda c: obtain_key(key, c), clients) if c is not None]
+    stage.done(len(clients))
+    return result
+
+
+def write_config(suma_salt, clients):
+    """
+    Inject the reactivation keys in the salt batches. Every client needs its own key, so the commands of a
+    batch are published at once and the returns are collected afterwards.
+    Returns the clients which have been changed.
+    """
+    stage = Stage("write config")
+    changed = []
+    for n, batch in enumerate(chunks(clients, args.batch)):
+        if n and args.batch_wait:
+            time.sleep(args.batch_wait)
+        jobs = []
+        for c, p, r, s in batch:
+            sed_cmd = "sed -i -e 's/^\(\s*\)susemanager:.*$/\\1susemanager:\\n\\1    management_key: {}/' {}".format(r, p)
+            if args.dryrun:
+                print('DRYRUN: suma_salt.cmd({}, "cmd.retcode", ["{}"])'.format(c, sed_cmd))
+                changed.append((c, s))
+                continue
+            jid = suma_salt.cmd_async(c, "cmd.retcode", [sed_cmd])
+            if not jid:
+                print('ERROR: Unable to publish config change to salt client {}'.format(c))
+                continue
+            jobs.append((jid, c, s))
+        for jid, c, s in jobs:
+            ret = suma_salt.get_full_returns(jid, [c], timeout=args.timeout).get(c, {}).get("ret")
+            if ret == 0:
+                print('Salt client {} reactivation key set'.format(c))
+                changed.append((c, s))
+            else:
+                print('ERROR: Unable to set reactivation key on salt client {}: {}'.format(c, ret))
+    stage.done(len(clients))
+    return changed
+
+
+def restart_minions(suma_salt, clients):
+    """
+    Restart the salt clients with a salt batch job per salt service.
+    """
+    stage = Stage("restart")
+    for service in sorted({s for _, s in clients}):
+        targets = [c for c, s in clients if s == service]
+        restart_cmd = "sleep 2;service {} restart".format(service)
+        if args.dryrun:
+            print('DRYRUN: suma_salt.cmd_batch({}, "cmd.run_bg", ["{}"], tgt_type="list", batch="{}", batch_wait={})'.format(
+                ",".join(targets), restart_cmd, args.batch, args.batch_wait))
             continue
+        print('Restarting {} on {} salt clients'.format(service, len(targets)))
+        for ret in suma_salt.cmd_batch(targets, "cmd.run_bg", [restart_cmd], tgt_type="list", batch=str(args.batch),
+                                       batch_wait=args.batch_wait, timeout=args.timeout):
+            for c in ret:
+                print('Salt client {} restarting {}'.format(c, service))
+    stage.done(len(clients))
 
-        c_key = "reactivation key"
-        if args.dryrun:
-            print('DRYRUN: suma_rpc.system.obtainReactivationKey(key, {})'.format(c_id))
-        else:
-            c_key = suma_rpc.system.obtainReactivationKey(key, c_id)
-        clients.append((c_saltid, c_configpath, c_key, c_service))
 
-    for c, p, r, s in clients:
-        sed_cmd = "sed -i -e 's/^\(\s*\)susemanager:.*$/\\1susemanager:\\n\\1    management_key: {}/' {}".format(r, p)
-        if args.dryrun:
-            print('DRYRUN: suma_salt.cmd({}, "cmd.run", ["{}"])'.format(c, sed_cmd))
-            print('DRYRUN: suma_salt.cmd({}, "cmd.run_bg", ["sleep 2;service {} restart"])'.format(c, s))
-        else:
-            suma_salt.cmd(c, "cmd.run", [sed_cmd])
-            print('Salt client {} reactivation key grain set, restarting {}'.format(c, s))
-            suma_salt.cmd(c, "cmd.run_bg", ["sleep 2;service {} restart".format(s)])
+if __name__ == "__main__":
+    total = Stage("total")
+    suma_rpc = get_rpc()
+    key = suma_rpc.auth.login(args.user, args.password)
+
+    client_mapping = suma_rpc.system.getMinionIdMap(key)
+    suma_salt = salt.client.LocalClient()
+    clients = collect_clients(suma_salt)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        clients = filter_connected(key, executor, clients, client_mapping)
+        clients = obtain_keys(key, executor, clients)
+
+    clients = write_config(suma_salt, clients)
+    restart_minions(suma_salt, clients)
+    suma_rpc.auth.logout(key)
+    total.done(len(clients))
 
     print("All done, wait until all salt clients reactivates and check proxy connections")
@@ -6,24 +6,35 @@
 # GNU Public License. No warranty. No Support
 # For question/suggestions/bugs mail: michael.brookhuis@suse.com
 #
-# Version: 2020-04-01
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis.
 #
 # Releases:
 # 2020-04-01 M.Brookhuis - initial release.
+# 2026-10-19 - Added --file to bootstrap many servers in parallel, with retries and a retry file.
 #
 """This program will add the give system to the software-, configurationchannels and systemgroups after migration"""
 import sys
 import argparse
 from argparse import RawTextHelpFormatter
 import os
+import random
+import re
+import threading
 import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
 import smtools
 import datetime
 import time
 
 __smt = None
+connections = threading.local()
+
+# bootstrap errors which are worth a retry, the server could not be reached (yet). Other ssh errors, like
+# authentication or host key failures, are not retried.
+TRANSIENT_ERRORS = re.compile(r"timed? ?out|connection (refused|reset|closed)|no route to host|unreachable|"
+                              r"temporary failure in name resolution", re.IGNORECASE)
 
 
 def perform_bootstrap(server, akey):
@@ -34,6 +45,95 @@ def perform_bootstrap(server, akey):
      smt.log_info("server {} registered".format(server))
 
 
+def get_client():
+     """
+     Connection to SUSE Manager of the current thread
+     """
+     if not hasattr(connections, 'client'):
+         connections.client = smt.suman_connect()
+     return connections.client
+
+
+def read_hosts(file, akey):
+     """
+     Read the servers to register. Every line contains a server and optional the activationkey to use,
+     separated by a space or comma. Without activationkey the key given with --activationkey is used.
+     """
+     hosts = []
+     try:
+         with open(file) as h_file:
+             for line in h_file:
+                 fields = line.replace(',', ' ').split()
+                 if not fields or fields[0].startswith('#'):
+                     continue
+                 key = fields[1] if len(fields) > 1 else akey
+                 if not key:
+                     smt.minor_error("No activationkey given for server {}".format(fields[0]))
+                     continue
+                 hosts.append((fields[0], key))
+     except IOError:
+         smt.fatal_error("Can't open file {} for reading".format(file))
+     return hosts
+
+
+def bootstrap_host(server, akey, retries):
+     """
+     Bootstrap one server. Transient errors are retried with an exponential backoff.
+     Returns the server, activationkey, error message (None on success), number of attempts and the latency.
+     """
+     start = time.monotonic()
+     attempt = 0
+     while True:
+         attempt += 1
+         try:
+             get_client().system.bootstrap(smt.session, server, 22, "root", "", akey, True)
+             smt.log_info("server {} registered in {:.0f} seconds".format(server, time.monotonic() - start))
+             return server, akey, None, attempt, time.monotonic() - start
+         except xmlrpc.client.Fault as err:
+             error = err.faultString
+             transient = bool(TRANSIENT_ERRORS.search(error))
+         except (OSError, xmlrpc.client.ProtocolError) as err:
+             error = str(err)
+             transient = True
+             # the connection may be broken, use a new one for the next attempt
+             if hasattr(connections, 'client'):
+                 del connections.client
+         if not transient or attempt > retries:
+             smt.log_error("Error bootstrapping server {}: {}".format(server, error))
+             return server, akey, error, attempt, time.monotonic() - start
+         wait = 10 * 2 ** (attempt - 1) + random.uniform(0, 5)
+         smt.log_warning("Bootstrapping server {} failed: {}. Retry in {:.0f} seconds".format(server, error, wait))
+         time.sleep(wait)
+
+
+def bootstrap_many(args):
+     """
+     Bootstrap all servers in the file with at most args.jobs at the same time. The servers that could not be
+     registered are written to the retry file, which can be used as --file for the next run.
+     """
+     hosts = read_hosts(args.file, args.activationkey)
+     retry_file = args.retry_file or args.file + ".retry"
+     start = time.monotonic()
+     with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+         results = list(executor.map(lambda h: bootstrap_host(h[0], h[1], args.retries), hosts))
+     failed = []
+     for server, akey, error, attempts, latency in results:
+         if error:
+             failed.append((server, akey))
+             smt.minor_error("{}: failed after {} attempts and {:.0f} seconds: {}".format(server, attempts, latency, error))
+         else:
+             smt.log_info("{}: registered in {:.0f} seconds ({} attempts)".format(server, latency, attempts))
+     if failed:
+         with open(retry_file, "w") as h_retry:
+             for server, akey in failed:
+                 h_retry.write("{} {}\n".format(server, akey))
+         smt.log_info("Failed servers are written to {}".format(retry_file))
+     elif os.path.exists(retry_file):
+         os.remove(retry_file)
+     smt.log_info("{} of {} servers registered in {:.0f} seconds".format(len(results) - len(failed), len(results),
+                                                                       time.monotonic() - start))
+
+
 def main():
      """
      Main Function
@@ -43,15 +143,31 @@ def main():
           Usage:
           register_system.py
 
+          With --file all servers in the file are registered, with at most --jobs at the same time.
                 '''))
      parser.add_argument('-s', '--server', help='name of the server to receive config update. Required')
      parser.add_argument('-a', '--activationkey', help='activationkey to use for registration')
+     parser.add_argument('-f', '--file', help='file with the servers to register, 1 server per line. '
+                                              'An activationkey can be given after the server name.')
+     parser.add_argument('-j', '--jobs', type=int, default=5, help='number of servers registered at the same time. Default 5')
+     parser.add_argument('-r', '--retries', type=int, default=3,
+                         help='number of retries when a server could not be reached. Default 3')
+     parser.add_argument('--retry-file', help='file for the servers that could not be registered. Default <file>.retry')
 
      parser.add_argument('--version', action='version', version='%(prog)s 1.0.0, April 1, 2020')
      args = parser.parse_args()
-     if not args.server:
+     if args.file and args.server:
+         smt = smtools.SMTools("register_system")
+         smt.log_error("The options --server and --file can not be used together. Exiting script")
+         smt.exit_program(1)
+     elif args.file:
+         smt = smtools.SMTools("register_system")
+         smt.suman_login()
+         smt.log_info("Start")
+         bootstrap_many(args)
+     elif not args.server:
          smt = smtools.SMTools("register_system")
-         smt.log_error("The option --server is mandatory. Exiting script")
+         smt.log_error("The option --server or --file is mandatory. Exiting script")
          smt.exit_program(1)
      elif not args.activationkey:
          smt = smtools.SMTools("register_system")
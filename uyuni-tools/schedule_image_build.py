@@ -1,5 +1,7 @@
 import datetime
+import heapq
 import os
+import time
 import xmlrpc.client
 import yaml
 import argparse
@@ -8,7 +10,7 @@ import smtools
 
 
 # Earliest possible start time for the build (Optional, default is immediately)
-# Example: Now + 5 minutes
+# Example: Now + 5 minutes. It is calculated when the build is scheduled, not when the script is loaded.
 # Note: isoformat() typically includes microseconds. If your Python version is older than 3.7,
 # it might not have fromisoformat(). For broader compatibility, we'll use strptime.
 # We'll generate the string with a specific format here that strptime can then parse.
@@ -16,7 +18,8 @@ import smtools
 # so let's format it explicitly if strptime is used.
 # The default .isoformat() of datetime.datetime.now() usually looks like 'YYYY-MM-DDTHH:MM:SS.ffffff'
 # We need to make sure our strptime format matches this.
-EARLIEST_OCCURRENCE = (datetime.datetime.now() + datetime.timedelta(minutes=5)).isoformat(timespec='microseconds')
+def start_time(minutes=5):
+    return (datetime.datetime.now() + datetime.timedelta(minutes=minutes)).isoformat(timespec='microseconds')
 
 def schedule_image_build(profile_label, version, build_host_id, earliest_occurrence=None):
     """
@@ -34,6 +37,206 @@ def schedule_image_build(profile_label, version, build_host_id, earliest_occurre
             earliest_occurrence_dt = datetime.datetime.strptime(earliest_occurrence, "%Y-%m-%dT%H:%M:%S.%f")
     smt.image_schedule_image_build(profile_label, version, build_host_id, earliest_occurrence_dt)
 
+
+def read_matrix(matrix_file):
+    """
+    Reads the builds from a yaml file:
+
+    build_hosts:
+      - buildhost1.example.com
+      - buildhost2.example.com
+    builds:
+      my-custom-image-profile: 1.0.0
+      other-image-profile:
+        - 1.0.0
+        - 2.0.0
+
+    :return: list of (profile, version) and the list of build host names
+    """
+    try:
+        with open(matrix_file) as h_matrix:
+            matrix = yaml.safe_load(h_matrix) or {}
+    except (IOError, yaml.YAMLError) as err:
+        smt.fatal_error(f"Unable to read {matrix_file}: {err}")
+    builds = []
+    for profile, versions in (matrix.get('builds') or {}).items():
+        if not isinstance(versions, list):
+            versions = [versions]
+        for version in versions:
+            builds.append((profile, str(version)))
+    return builds, matrix.get('build_hosts') or []
+
+
+def resolve_build_hosts(names):
+    """
+    Resolves the build hosts with one listing of all systems.
+
+    :return: dict with system id and name of the build hosts
+    """
+    ids = {}
+    for system in smt.system_listsystems():
+        ids.setdefault(system.get('name'), []).append(system.get('id'))
+    hosts = {}
+    for name in names:
+        if len(ids.get(name, [])) != 1:
+            smt.minor_error(f"Build host {name} not found or not unique. It will not be used.")
+        else:
+            hosts[ids[name][0]] = name
+    return hosts
+
+
+def host_events(host_id):
+    try:
+        return smt.client.system.listSystemEvents(smt.session, host_id)
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: system.listSystemEvents')
+        smt.log_debug(f"Error: \n{err}")
+        smt.minor_error(f"Unable to get the events of build host {host_id}")
+        return []
+
+
+def is_image_build(event):
+    return 'image' in (event.get('action_type') or '').lower()
+
+
+def is_finished(event):
+    return bool(event.get('successful_count') or event.get('failed_count') or event.get('completion_time'))
+
+
+def queued_builds(hosts):
+    """
+    Counts the image builds which are scheduled but not finished per build host.
+    """
+    return {host_id: len([e for e in host_events(host_id) if is_image_build(e) and not is_finished(e)])
+            for host_id in hosts}
+
+
+def assign_builds(builds, hosts):
+    """
+    Spreads the builds over the build hosts. Every build goes to the host with the fewest queued builds.
+
+    :return: list of (profile, version, host id)
+    """
+    queued = queued_builds(hosts)
+    for host_id, name in hosts.items():
+        smt.log_info(f"Build host {name} has {queued[host_id]} image builds queued")
+    heap = [(count, host_id) for host_id, count in queued.items()]
+    heapq.heapify(heap)
+    assigned = []
+    for profile, version in builds:
+        count, host_id = heapq.heappop(heap)
+        assigned.append((profile, version, host_id))
+        heapq.heappush(heap, (count + 1, host_id))
+    return assigned
+
+
+def schedule_builds(assigned, hosts, delay, stagger):
+    """
+    Schedules all builds, the start times are staggered by stagger seconds.
+
+    :return: dict with action id and (profile, version, host id)
+    """
+    start = datetime.datetime.now() + datetime.timedelta(minutes=delay)
+    actions = {}
+    for n, (profile, version, host_id) in enumerate(assigned):
+        date = start + datetime.timedelta(seconds=n * stagger)
+        try:
+            action_id = smt.client.image.scheduleImageBuild(smt.session, profile, version, host_id, date)
+        except xmlrpc.client.Fault as err:
+            smt.log_debug('api-call: image.scheduleImageBuild')
+            smt.log_debug(f"Error: \n{err}")
+            smt.minor_error(f"Unable to schedule image build {profile} {version} on {hosts[host_id]}.")
+            continue
+        smt.log_info(f"Image build {profile} {version} scheduled on {hosts[host_id]} at {date:%H:%M:%S}, action {action_id}")
+        actions[action_id] = (profile, version, host_id)
+    return actions
+
+
+def event_duration(event):
+    """
+    Returns the build duration in seconds from the pickup and completion time of the event, None if not known.
+    """
+    try:
+        pickup = datetime.datetime.strptime(str(event.get('pickup_time')), "%Y%m%dT%H:%M:%S")
+        completion = datetime.datetime.strptime(str(event.get('completion_time')), "%Y%m%dT%H:%M:%S")
+    except ValueError:
+        return None
+    return (completion - pickup).total_seconds()
+
+
+def wait_for_builds(actions, timeout):
+    """
+    Follows all builds with one poller. Every round the events of the build hosts with running builds are read
+    once.
+
+    :return: dict with action id and (result, duration in seconds)
+    """
+    end_time = time.monotonic() + timeout
+    try:
+        wait_time = smtools.CONFIGSM['maintenance']['wait_between_events_check']
+    except KeyError:
+        wait_time = 30
+    results = {}
+    pending = set(actions)
+    while pending and time.monotonic() < end_time:
+        time.sleep(wait_time)
+        for host_id in {actions[a][2] for a in pending}:
+            for event in host_events(host_id):
+                action_id = event.get('id')
+                if action_id in pending and is_finished(event):
+                    result = "failed" if event.get('failed_count') else "completed"
+                    results[action_id] = (result, event_duration(event))
+                    pending.discard(action_id)
+                    profile, version, _ = actions[action_id]
+                    smt.log_info(f"Image build {profile} {version} {result}")
+        smt.log_info(f"{len(pending)} image builds still running")
+    for action_id in pending:
+        results[action_id] = ("timeout", None)
+    return results
+
+
+def report(actions, results, hosts):
+    """
+    Logs the result of every build and a summary of the build durations per build host.
+    """
+    per_host = {}
+    for action_id, (profile, version, host_id) in sorted(actions.items(), key=lambda a: a[1]):
+        result, duration = results[action_id]
+        duration_text = f"{duration:.0f} seconds" if duration is not None else "unknown time"
+        if result == "completed":
+            smt.log_info(f"{profile} {version} on {hosts[host_id]}: completed in {duration_text}")
+        else:
+            smt.minor_error(f"{profile} {version} on {hosts[host_id]}: {result} after {duration_text}")
+        per_host.setdefault(host_id, []).append((result, duration))
+    smt.log_info(f"{'Build host':40} {'builds':>6} {'failed':>6} {'total':>10} {'average':>10} {'longest':>10}")
+    for host_id, host_results in sorted(per_host.items(), key=lambda h: hosts[h[0]]):
+        durations = [d for r, d in host_results if r == "completed" and d is not None]
+        failed = len([r for r, _ in host_results if r != "completed"])
+        total = sum(durations)
+        average = total / len(durations) if durations else 0
+        longest = max(durations) if durations else 0
+        smt.log_info(f"{hosts[host_id]:40} {len(host_results):6d} {failed:6d} {total:9.0f}s {average:9.0f}s {longest:9.0f}s")
+
+
+def schedule_matrix(args):
+    """
+    Schedules all builds of the matrix file on the pool of build hosts.
+    """
+    builds, host_names = read_matrix(args.matrix)
+    if args.build_hosts:
+        host_names = args.build_hosts.split(',')
+    if not builds:
+        smt.fatal_error(f"No builds found in {args.matrix}")
+    hosts = resolve_build_hosts(host_names)
+    if not hosts:
+        smt.fatal_error("No build host available")
+    assigned = assign_builds(builds, hosts)
+    actions = schedule_builds(assigned, hosts, args.delay, args.stagger)
+    if args.nowait:
+        return
+    results = wait_for_builds(actions, args.timeout)
+    report(actions, results, hosts)
+
 def main():
     """
     Main function
@@ -43,9 +246,9 @@ def main():
     parser = argparse.ArgumentParser(
         description="Schedules an image build in SuSE Manager."
     )
-    parser.add_argument("-p", "--profile-label", type=str, required=True,
+    parser.add_argument("-p", "--profile-label", type=str,
                         help="The label of the image profile to be built (e.g., 'my-custom-image-profile').")
-    parser.add_argument("-i", "--image-version", type=str, required=True,
+    parser.add_argument("-i", "--image-version", type=str,
                         help="The version of the image (e.g., '1.0.0').")
     parser.add_argument("-b", "--build-host-id", type=int,
                         help="The System ID of the build host in SuSE Manager. If not provided, "
@@ -53,13 +256,35 @@ def main():
     parser.add_argument("-n", "--build-host-name", type=str,
                         help="The hostname of the build system in SuSE Manager. "
                              "Used if --build-host-id is not provided.")
+    parser.add_argument("-m", "--matrix", type=str,
+                        help="Yaml file with the image profiles and versions to be built and the build hosts to use. "
+                             "The builds are spread over the build hosts.")
+    parser.add_argument("--build-hosts", type=str,
+                        help="Comma separated list of build hosts to use with --matrix, instead of the build hosts "
+                             "in the matrix file.")
+    parser.add_argument("--delay", type=int, default=5,
+                        help="Minutes from now when the (first) build starts. Default 5.")
+    parser.add_argument("--stagger", type=int, default=60,
+                        help="Seconds between the start times of the builds with --matrix. Default 60.")
+    parser.add_argument("--timeout", type=int, default=14400,
+                        help="Seconds to wait for the builds with --matrix. Default 14400.")
+    parser.add_argument("--nowait", action="store_true", default=False,
+                        help="With --matrix, only schedule the builds and don't wait for them.")
     args = parser.parse_args()
 
-    smt = smtools.SMTools("create_software_project")
+    smt = smtools.SMTools("schedule_image_build")
     # login to suse manager
     smt.log_info("Start")
     smt.suman_login()
 
+    if args.matrix:
+        schedule_matrix(args)
+        smt.close_program()
+    if not args.profile_label or not args.image_version:
+        smt.log_error("Error: --profile-label and --image-version, or --matrix must be provided.")
+        parser.print_help()
+        smt.exit_program(1)
+
     resolved_build_host_id = None
     if args.build_host_id:
         resolved_build_host_id = args.build_host_id
@@ -76,7 +301,7 @@ def main():
     smt.log_info(f"  Image Version: {args.image_version}")
     smt.log_info(f"  Build Host ID: {resolved_build_host_id}")
 
-    schedule_image_build(args.profile_label, args.image_version, resolved_build_host_id, EARLIEST_OCCURRENCE)
+    schedule_image_build(args.profile_label, args.image_version, resolved_build_host_id, start_time(args.delay))
     smt.close_program()
 
 if __name__ == "__main__":
@@ -18,6 +18,7 @@
 # 2020-03-21 M.Brookhuis - RC 1 if there has been an error
 # 2020-11-09 M.Brookhuis - Added maintenance|wait_between_events_check option. This should also be added to configsm.yaml.
 # 2021-01-05 M.Brookhuis - Optimized events checking
+# 2026-10-19 - Added suman_connect to open extra connections for parallel API calls
 #
 # coding: utf-8
 
@@ -256,6 +257,20 @@ class SMTools:
             except:
                 self.fatal_error("Unable to login to SUSE Manager server {} XMLRPC".format(CONFIGSM['suman']['server']))
 
+    def suman_connect(self):
+        """
+        Open a new connection to SUSE Manager Server. The session of suman_login can be used with it, so
+        every thread can get its own connection.
+        """
+        if CONFIGSM['suman']['ssl_certificate_check']:
+            return xmlrpc.client.Server("https://" + CONFIGSM['suman']['server'] + "/rpc/api")
+        context_xmlrpc = ssl.create_default_context()
+        context_xmlrpc.check_hostname = False
+        context_xmlrpc.verify_mode = ssl.CERT_NONE
+        transport = xmlrpc.client.Transport()
+        transport._ssl_wrap = lambda host, **kwargs: context_xmlrpc.wrap_socket(socket.create_connection((host, 443)), server_hostname=host)
+        return xmlrpc.client.Server("https://" + CONFIGSM['suman']['server'] + "/rpc/api", transport=transport)
+
     '''
         def suman_login(self):
             """
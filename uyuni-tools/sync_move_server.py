@@ -4,7 +4,7 @@
 # GNU Public License. No warranty. No Support
 # For question/suggestions/bugs mail: michael.brookhuis@suse.com
 #
-# Version: 2025-07-30
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis
 #
@@ -12,6 +12,8 @@
 #
 # Releases:
 # 2025-07-30 M.Brookhuis - initial release.
+# 2026-10-19 - Added --file to move a list of servers with one login to both SMLM servers.
+#            - Rename rules are compiled once, added --explain
 #
 
 """
@@ -21,15 +23,21 @@ This program will sync the give stage
 import argparse
 import base64
 import datetime
+import re
 import socket
 import ssl
 import sys
+import threading
+import time
 import xmlrpc.client
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 
 import smtools
 
 __smt = None
+rules = None
+connections = threading.local()
 
 class SMLM:
     client = ""
@@ -45,7 +53,8 @@ class SMLM:
         self.skip_ssl_check = skip_ssl_check
         self.login_smlm()
 
-        self.set_hostname()
+        if self.server:
+            self.set_hostname()
 
     def login_smlm(self):
         """
@@ -84,6 +93,19 @@ class SMLM:
             except:
                 smt.fatal_error(f"Unable to login to SUSE Manager server {self.fromsmlm} XMLRPC")
 
+    def connect(self):
+        """
+        Open a new connection to the previous SMLM. The session of login_smlm can be used with it.
+        """
+        if not self.skip_ssl_check:
+            return xmlrpc.client.Server("https://" + self.fromsmlm + "/rpc/api")
+        context_xmlrpc = ssl.create_default_context()
+        context_xmlrpc.check_hostname = False
+        context_xmlrpc.verify_mode = ssl.CERT_NONE
+        transport = xmlrpc.client.Transport()
+        transport._ssl_wrap = lambda host, **kwargs: context_xmlrpc.wrap_socket(socket.create_connection((host, 443)), server_hostname=host)
+        return xmlrpc.client.Server("https://" + self.fromsmlm + "/rpc/api", transport=transport)
+
     def set_hostname(self, fatal=True):
         """
         Set hostnam for global use.
@@ -176,6 +198,135 @@ class SMLM:
             smt.log_debug("Error: \n{}".format(err))
             smt.fatal_error('Unable to get subscribed child channels for server {}.'.format(self.server))
 
+class PrefixTrie:
+    """
+    Find all values stored for the prefixes of a text with one walk over the text.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def matches(self, text):
+        node = self.root
+        found = list(node.get(None, []))
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            found.extend(node.get(None, []))
+        return found
+
+
+def alternation(parts, flags=0):
+    """
+    Compile the parts into one regular expression matching any of them, or None when there are no parts
+    """
+    parts = [re.escape(part) for part in parts]
+    if not parts:
+        return None
+    return re.compile("|".join(sorted(parts, key=len, reverse=True)), flags)
+
+
+class RenameRules:
+    """
+    The rules of the migrate section in configsm.yaml, compiled once. Labels not touched by any rule are
+    rejected with one regular expression search, the rules are applied in the order of configsm.yaml.
+    The result of every label is cached.
+    """
+
+    def __init__(self, migrate, explain=False):
+        self.explain = explain
+        self.skip_channels = alternation(migrate.get('skip_channels') or [])
+        self.rename_channels = list((migrate.get('rename_channels') or {}).items())
+        self.rename_channels_re = alternation([f for f, _ in self.rename_channels])
+        self.project_labels = PrefixTrie()
+        for order, (label, new_label) in enumerate((migrate.get('project_labels') or {}).items()):
+            label_elements = label.split('*')
+            self.project_labels.add(label_elements[0], (order, label, label_elements, new_label))
+        self.rename_groups = [(f.lower(), t) for f, t in (migrate.get('rename_groups') or {}).items()]
+        self.rename_groups_re = alternation([f for f, _ in self.rename_groups])
+        self.os_groups = PrefixTrie()
+        order = 0
+        for group, prefixs in (migrate.get('os_groups') or {}).items():
+            for prefix in prefixs:
+                self.os_groups.add(prefix, (order, prefix, group))
+                order += 1
+        self.channels = {}
+        self.groups = {}
+        self.base_channels = {}
+        self.lock = threading.Lock()
+
+    def log_explain(self, kind, old, new, fired):
+        if self.explain:
+            smt.log_info(f"explain: {kind} {old} -> {new}: {', '.join(fired) if fired else 'no rule'}")
+
+    def channel(self, channel):
+        """
+        Return the new channel label, or None when the channel is skipped
+        """
+        with self.lock:
+            if channel not in self.channels:
+                self.channels[channel] = self.map_channel(channel)
+            return self.channels[channel]
+
+    def map_channel(self, channel):
+        old_channel = channel
+        fired = []
+        if self.skip_channels:
+            match = self.skip_channels.search(channel)
+            if match:
+                self.log_explain("channel", old_channel, None, [f"skip_channels '{match.group(0)}'"])
+                return None
+        if self.rename_channels_re and self.rename_channels_re.search(channel):
+            for rename_from, rename_to in self.rename_channels:
+                if rename_from in channel:
+                    channel = channel.replace(rename_from, rename_to)
+                    fired.append(f"rename_channels '{rename_from}' -> '{rename_to}'")
+        for _, label, label_elements, new_label in sorted(self.project_labels.matches(channel)):
+            if all(x in channel for x in label_elements):
+                channel = channel.replace(label_elements[0], new_label, 1)
+                fired.append(f"project_labels '{label}' -> '{new_label}'")
+                break
+        self.log_explain("channel", old_channel, channel, fired)
+        return channel
+
+    def group(self, group):
+        """
+        Return the new group name
+        """
+        with self.lock:
+            if group not in self.groups:
+                new_group = group
+                fired = []
+                if self.rename_groups_re and self.rename_groups_re.search(group.lower()):
+                    for rename_from, rename_to in self.rename_groups:
+                        if rename_from in group.lower():
+                            new_group = rename_to
+                            fired.append(f"rename_groups '{rename_from}' -> '{rename_to}'")
+                            break
+                self.log_explain("group", group, new_group, fired)
+                self.groups[group] = new_group
+            return self.groups[group]
+
+    def os_group(self, base_channel):
+        """
+        Return the OS group of the base channel, or None when no OS group is defined for it
+        """
+        with self.lock:
+            if base_channel not in self.base_channels:
+                matches = sorted(self.os_groups.matches(base_channel))
+                group = matches[0][2] if matches else None
+                self.log_explain("OS group of", base_channel, group,
+                                 [f"os_groups '{matches[0][1]}'"] if matches else [])
+                self.base_channels[base_channel] = group
+            return self.base_channels[base_channel]
+
 # ==========================================================
 
 def sync_configchannels(smlm_old, exitonerror):
@@ -229,31 +380,31 @@ def sync_systemgroups(smlm_old, exitonerror):
 def add_os_group(exitonerror):
     base_channel = smt.system_getsubscribedbasechannel().get('label')
     try:
-        for group, prefixs in smtools.CONFIGSM['migrate']['os_groups'].items():
-            for prefix in prefixs:
-                if base_channel.startswith(prefix):
-                    smt.system_set_group_membership(smt.systemgroup_get_details(group).get('id'), exitonerror)
-                    smt.log_info(f"Group {group} set")
-                    return
+        group = os_group(base_channel)
+        if group:
+            smt.system_set_group_membership(smt.systemgroup_get_details(group).get('id'), exitonerror)
+            smt.log_info(f"Group {group} set")
     except:
         smt.log_debug("error when adding to OS group")
         pass
 
 
+def os_group(base_channel):
+    """
+    Find the OS group for the base channel
+    :param base_channel:
+    :return: group name or None when no OS group is defined for the base channel
+    """
+    return rules.os_group(base_channel)
+
+
 def group_name(group):
     """
     Find the new group name
     :param group:
     :return: new group name or old group when no change is needed
     """
-    try:
-        for rename_from, rename_to in smtools.CONFIGSM['migrate']['rename_groups'].items():
-            if rename_from.lower() in group.lower():
-                group = rename_to
-                return group
-    except KeyError:
-        pass
-    return group
+    return rules.group(group)
 
 def sync_repos(server, smlm_old, exitonerror):
     """
@@ -265,10 +416,11 @@ def sync_repos(server, smlm_old, exitonerror):
     :return:
     """
     smt.log_info("start setting repositories")
-    base_channel = channel_name(smlm_old.system_getsubscribedbasechannel().get('label'))
+    all_channels = set(smt.get_labels_all_channels())
+    base_channel = channel_name(smlm_old.system_getsubscribedbasechannel().get('label'), all_channels)
     child_channels = []
     for child_channel in smlm_old.system_listsubscribedchildchannels():
-        new_child_channel = channel_name(child_channel.get('label'))
+        new_child_channel = channel_name(child_channel.get('label'), all_channels)
         if new_child_channel:
             child_channels.append(new_child_channel)
         else:
@@ -277,33 +429,14 @@ def sync_repos(server, smlm_old, exitonerror):
     smt.log_info("finished setting repositories")
     return
 
-def channel_name(channel):
+def channel_name(channel, all_channels):
     """
     Find the new channel name
     :param channel:
+    :param all_channels: set with the labels of all channels on the new SMLM
     :return: new channel name or nil when isn't needed/present
     """
-    try:
-        for skip_channel in smtools.CONFIGSM['migrate']['skip_channels']:
-            if skip_channel in channel:
-                return None
-    except KeyError:
-        pass
-    try:
-        for rename_from, rename_to in smtools.CONFIGSM['migrate']['rename_channels'].items():
-            if rename_from in channel:
-                channel = channel.replace(rename_from, rename_to)
-    except:
-        pass
-    try:
-        for label, new_label in smtools.CONFIGSM['migrate']['project_labels'].items():
-            label_elements = label.split('*')
-            if all([x in channel for x in label_elements]) and channel.startswith(label_elements[0]):
-                channel = channel.replace(label_elements[0], new_label, 1)
-                break
-    except:
-        pass
-    all_channels = smt.get_labels_all_channels()
+    channel = rules.channel(channel)
     if channel in all_channels:
         return channel
     return None
@@ -342,6 +475,252 @@ def sync_formulars(server, smlm_old, exitonerror):
     """
     return
 
+# ==========================================================
+
+def old_client(smlm_old):
+    """
+    Connection of the current thread to the previous SMLM
+    """
+    if not hasattr(connections, 'old'):
+        connections.old = smlm_old.connect()
+    return connections.old
+
+
+def new_client():
+    """
+    Connection of the current thread to the SMLM defined in configsm.yaml
+    """
+    if not hasattr(connections, 'new'):
+        connections.new = smt.suman_connect()
+    return connections.new
+
+
+def read_server_file(filename):
+    """
+    Read the servers to be synchronized, 1 server per line
+
+    :param filename:
+    :return: list of servers
+    """
+    try:
+        with open(filename) as sf:
+            return [line.strip() for line in sf if line.strip() and not line.startswith('#')]
+    except OSError:
+        smt.fatal_error(f"Given file {filename} doesn't exists. aborting")
+
+
+def system_ids(client, session, servers, smlm):
+    """
+    Get the system ids of the servers with one listing of all systems
+
+    :param client: connection to the SMLM
+    :param session: session on the SMLM
+    :param servers: list of servers
+    :param smlm: name of the SMLM, used for logging
+    :return: dict with server name and system id
+    """
+    try:
+        all_systems = client.system.listSystems(session)
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: system.listSystems')
+        smt.log_debug(f"Error: \n{err}")
+        smt.fatal_error(f"Unable to get list of systems from {smlm}")
+    found = {}
+    for system in all_systems:
+        found.setdefault(system.get('name'), []).append(system.get('id'))
+    ids = {}
+    for server in servers:
+        if server not in found:
+            smt.minor_error(f"Unable to get systemid from system {server} on {smlm}. Is this system registered?")
+        elif len(found[server]) > 1:
+            smt.minor_error(f"Duplicate system {server} on {smlm}. Please fix and run again.")
+        else:
+            ids[server] = found[server][0]
+    return ids
+
+
+def resolve_system(smlm_old, args, system, all_channels, all_groups):
+    """
+    Get the configuration channels, systemgroups and channels of a server from the previous SMLM and translate
+    them to the names on the new SMLM.
+
+    :param smlm_old: Connection information to the previous SMLM
+    :param args: given options
+    :param system: dict with server, old_id and new_id. The wanted configuration is added.
+    :param all_channels: set with the labels of all channels on the new SMLM
+    :param all_groups: set with the names of all systemgroups on the new SMLM
+    :return: list of items not present on the new SMLM
+    """
+    client = old_client(smlm_old)
+    session = smlm_old.session
+    old_id = system['old_id']
+    missing = []
+    try:
+        if args.all or args.configchannels:
+            system['config'] = [c.get('name') for c in client.system.config.listChannels(session, old_id)]
+        base_channel = None
+        if args.all or args.systemgroups or args.repos:
+            old_base = client.system.getSubscribedBaseChannel(session, old_id).get('label')
+            if old_base:
+                base_channel = channel_name(old_base, all_channels)
+        if args.all or args.systemgroups:
+            system['groups'] = []
+            for group in client.system.listGroups(session, old_id):
+                if group.get('subscribed') == 1:
+                    check_group = group_name(group.get('system_group_name'))
+                    if check_group in all_groups:
+                        system['groups'].append(check_group)
+                    else:
+                        missing.append(f"group {check_group}")
+            group = os_group(base_channel) if base_channel else None
+            if group in all_groups and group not in system['groups']:
+                system['groups'].append(group)
+        if args.all or args.repos:
+            if not base_channel:
+                missing.append("base channel")
+            else:
+                system['base'] = base_channel
+                system['children'] = []
+                for child_channel in client.system.listSubscribedChildChannels(session, old_id):
+                    new_child_channel = channel_name(child_channel.get('label'), all_channels)
+                    if new_child_channel:
+                        system['children'].append(new_child_channel)
+                    else:
+                        smt.log_warning(f"{system['server']}: skipping {child_channel.get('label')}")
+    except xmlrpc.client.Fault as err:
+        smt.log_debug(f"Error: \n{err}")
+        system['failed'] = True
+        smt.minor_error(f"Unable to get the configuration of server {system['server']} from {args.fromsmlm}")
+    return missing
+
+
+def set_configchannels(channels, systems):
+    try:
+        new_client().system.config.setChannels(smt.session, [s['new_id'] for s in systems], list(channels))
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: system.config.setChannels')
+        smt.log_debug(f'  channels:   {channels}')
+        smt.log_debug(f"Error: \n{err}")
+        for system in systems:
+            system['failed'] = True
+            smt.minor_error(f"Unable set configuration channels for server {system['server']}.")
+
+
+def add_to_group(group, systems):
+    try:
+        new_client().systemgroup.addOrRemoveSystems(smt.session, group, [s['new_id'] for s in systems], True)
+        smt.log_info(f"Group {group} set for {len(systems)} servers")
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: systemgroup.addOrRemoveSystems')
+        smt.log_debug(f'  Group:      {group}')
+        smt.log_debug(f"Error: \n{err}")
+        for system in systems:
+            system['failed'] = True
+            smt.minor_error(f"Unable to assign group membership {group} for server {system['server']}.")
+
+
+def schedule_change_channels(system, date):
+    try:
+        return new_client().system.scheduleChangeChannels(smt.session, system['new_id'], system['base'],
+                                                          system['children'], date)
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: system.scheduleChangeChannels')
+        smt.log_debug(f"  basechannel:   {system['base']}")
+        smt.log_debug(f"  childchannels: {system['children']}")
+        smt.log_debug(f"Error: \n{err}")
+        system['failed'] = True
+        smt.minor_error(f"Unable to schedule channel change for server {system['server']}.")
+        return None
+
+
+def wait_for_actions(actions):
+    """
+    Wait until all scheduled actions are finished. All actions are checked with one call per round.
+
+    :param actions: dict with action id and system
+    :return:
+    """
+    end_time = datetime.datetime.now() + datetime.timedelta(0, smtools.CONFIGSM['suman']['timeout'])
+    try:
+        wait_time = smtools.CONFIGSM['maintenance']['wait_between_events_check']
+    except KeyError:
+        wait_time = 30
+    pending = set(actions)
+    while pending and datetime.datetime.now() < end_time:
+        time.sleep(wait_time)
+        pending &= {a.get('id') for a in smt.client.schedule.listInProgressActions(smt.session)}
+        smt.log_info(f"Channel change still running for {len(pending)} servers")
+    failed = {a.get('id') for a in smt.client.schedule.listFailedActions(smt.session)}
+    for action_id, system in actions.items():
+        if action_id in pending:
+            system['failed'] = True
+            smt.minor_error(f"Action 'Change channels' run in timeout. Please check server {system['server']}.")
+        elif action_id in failed:
+            system['failed'] = True
+            smt.minor_error(f"Channel Change failed on server {system['server']}.")
+
+
+def start_batch_sync(args, user, password):
+    """
+    Synchronize all servers of the given file. Both SMLM are logged in once, the channels and systemgroups of
+    the new SMLM are read once and the changes are done in parallel for all servers.
+
+    :param args:
+    :param user:
+    :param password:
+    :return:
+    """
+    servers = read_server_file(args.file)
+    smt.log_info(f"Synchronizing {len(servers)} servers")
+    smt.suman_login()
+    smlm_old = SMLM(None, args.fromsmlm, user, password, args.skipsslcheck)
+    start = time.monotonic()
+    new_ids = system_ids(smt.client, smt.session, servers, "the new SMLM")
+    old_ids = system_ids(smlm_old.client, smlm_old.session, servers, args.fromsmlm)
+    systems = [{'server': server, 'old_id': old_ids[server], 'new_id': new_ids[server]}
+               for server in servers if server in old_ids and server in new_ids]
+    all_channels = set(smt.get_labels_all_channels())
+    all_groups = {g.get('name') for g in smt.systemgroup_list_all_groups()}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        all_missing = list(executor.map(lambda s: resolve_system(smlm_old, args, s, all_channels, all_groups), systems))
+    smt.log_info(f"Configuration of {len(systems)} servers read in {time.monotonic() - start:.1f} seconds")
+    missing_found = False
+    for system, missing in zip(systems, all_missing):
+        for item in missing:
+            missing_found = True
+            smt.log_error(f"{system['server']}: {item} not present")
+    if missing_found and args.exitonerror:
+        smt.fatal_error("Not all items are present on the new SMLM. No server has been changed. Exiting!!!!!")
+    systems = [s for s in systems if not s.get('failed')]
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        by_channels = {}
+        by_group = {}
+        for system in systems:
+            if 'config' in system:
+                by_channels.setdefault(tuple(system['config']), []).append(system)
+            for group in system.get('groups', []):
+                by_group.setdefault(group, []).append(system)
+        list(executor.map(lambda item: set_configchannels(*item), by_channels.items()))
+        list(executor.map(lambda item: add_to_group(*item), by_group.items()))
+        date = datetime.datetime.now()
+        to_change = [s for s in systems if 'base' in s]
+        action_ids = list(executor.map(lambda s: schedule_change_channels(s, date), to_change))
+    wait_for_actions({a: s for a, s in zip(action_ids, to_change) if a})
+    smt.log_info(f"Configuration of {len(systems)} servers set in {time.monotonic() - start:.1f} seconds")
+
+    synced = [s for s in systems if not s.get('failed')]
+    if args.delete and synced:
+        try:
+            smlm_old.client.system.deleteSystems(smlm_old.session, [s['old_id'] for s in synced], "NO_CLEANUP")
+            smt.log_info(f"deleted {len(synced)} servers from {args.fromsmlm}")
+        except xmlrpc.client.Fault as err:
+            smt.log_debug(f"Error: \n{err}")
+            smt.minor_error(f"Unable to delete servers from {args.fromsmlm}")
+    smt.log_info(f"{len(synced)} of {len(servers)} servers synchronized")
+    return
+
 def start_sync(args, user, password):
     """
     Start the sync process
@@ -350,6 +729,9 @@ def start_sync(args, user, password):
     :param password:
     :return:
     """
+    if args.file:
+        start_batch_sync(args, user, password)
+        return
     smt.suman_login()
     smt.set_hostname(args.server)
     smlm_old = SMLM(args.server, args.fromsmlm, user, password, args.skipsslcheck)
@@ -382,8 +764,11 @@ def check_arguments(args):
     :param args:
     :return:
     """
-    if not args.server:
-        smt.log_error("Option --server not given and is required. Aborting operation")
+    if not args.server and not args.file:
+        smt.log_error("Option --server or --file not given and is required. Aborting operation")
+        sys.exit(1)
+    if args.server and args.file:
+        smt.log_error("Option --server and --file can not be used together. Aborting operation")
         sys.exit(1)
     if not args.fromsmlm:
         smt.log_error("Option --fromsmlm not given and is required. Aborting operation")
@@ -417,17 +802,22 @@ def main():
     """
     Main section
     """
-    global smt
+    global smt, rules
     smt = smtools.SMTools("sync_move_server")
     parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description=('''\
          Usage:
          sync_move_server.py
 
          This script will only make the given server member of the systemgroups, or assign the correct software channels and repositories.
+         With --file all servers in the file are synchronized with one login to both SMLM servers.
          It will not create the give objects or check if the data is the same as on the old SMLM server.
 
                '''))
     parser.add_argument("-s", "--server", help="name of the server moved to the SMLM defined in configsm.yaml")
+    parser.add_argument("-l", "--file", help="file with the servers moved to the SMLM defined in configsm.yaml. "
+                                             "There should be 1 server per line")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="Number of servers handled at the same time when using --file. Default 8")
     parser.add_argument("-f", "--fromsmlm", help="SMLM from which the server has been moved")
     parser.add_argument("-u", "--user", help="user from SMLM server where the server is previously")
     parser.add_argument("-p", "--password", help="password of the user")
@@ -451,10 +841,13 @@ def main():
                         help="When set, exit when a item is missing on the new server. Otherwise only report.")
     parser.add_argument("-k", "--skipsslcheck", action="store_true", default=0,
                         help="When set, exit when a item is missing on the new server. Otherwise only report.")
+    parser.add_argument("-x", "--explain", action="store_true", default=0,
+                        help="Log which rule of the migrate section in configsm.yaml changed a channel or group.")
     parser.add_argument('--version', action='version', version='%(prog)s 1.0.0, June 7, 2025')
     args = parser.parse_args()
     smt.log_info("Start")
     smt.log_debug("Given options: {}".format(args))
+    rules = RenameRules(smtools.CONFIGSM.get('migrate') or {}, args.explain)
     user, password = check_arguments(args)
 
     start_sync(args, user, password)
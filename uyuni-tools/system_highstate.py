@@ -5,7 +5,7 @@
 # (c) 2025 SUSE Linux GmbH, Germany.
 # GNU Public License. No warranty. No Support
 #
-# Version: 2025-07-29
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis
 #
@@ -13,42 +13,223 @@
 #
 # Releases:
 # 2025-07-29 M.Brookhuis - Initial release
+# 2026-10-19 - Added --group and --file to perform a highstate on many systems at once
 #
 
 """
-This script will perform a highstate on the give system
+This script will perform a highstate on the give system, or on all systems of a group or file
 """
 
 import argparse
 import datetime
+import time
 import xmlrpc.client
 
 import smtools
 
+__smt = None
+
+
+def resolve_group(group):
+    """
+    Get the systems of the group
+
+    :param group: name of the systemgroup
+    :return: dict with system id and system name
+    """
+    return {s.get('id'): s.get('name') for s in smt.systemgroup_listsystemminimal(group)}
+
+
+def resolve_file(file):
+    """
+    Get the systems in the file, 1 system per line. All systems are resolved with one listing of all systems.
+
+    :param file: file with the systems
+    :return: dict with system id and system name
+    """
+    try:
+        with open(file) as h_file:
+            names = [line.strip() for line in h_file if line.strip()]
+    except IOError:
+        smt.fatal_error(f"Can't open file {file} for reading")
+    ids = {}
+    for system in smt.system_listsystems():
+        ids.setdefault(system.get('name'), []).append(system.get('id'))
+    targets = {}
+    for name in names:
+        if name not in ids:
+            smt.minor_error(f"Unable to get systemid from system {name}. Is this system registered?")
+        elif len(ids[name]) > 1:
+            smt.minor_error(f"Duplicate system {name}. Please fix and run again.")
+        else:
+            targets[ids[name][0]] = name
+    return targets
+
+
+def schedule_highstate(targets, chunk, test):
+    """
+    Schedule the highstate for all systems, with one action per chunk of systems
+
+    :param targets: dict with system id and system name
+    :param chunk: number of systems per action
+    :param test: run the highstate in test mode
+    :return: dict with action id and the system ids of the action
+    """
+    date = xmlrpc.client.DateTime(datetime.datetime.now())
+    sids = sorted(targets)
+    actions = {}
+    for i in range(0, len(sids), chunk):
+        part = sids[i:i + chunk]
+        try:
+            action_id = smt.client.system.scheduleApplyHighstate(smt.session, part, date, test)
+        except xmlrpc.client.Fault as err:
+            smt.log_debug('api-call: system.scheduleApplyHighstate')
+            smt.log_debug(f'  system_ids:     {part}')
+            smt.log_debug(f"Error: \n{err}")
+            for sid in part:
+                smt.minor_error(f"Unable to schedule highstate for server {targets[sid]}.")
+            continue
+        smt.log_info(f"Highstate scheduled for {len(part)} servers, action {action_id}")
+        actions[action_id] = part
+    return actions
+
+
+def parse_time(value):
+    """
+    Convert a dateTime.iso8601 of the API to datetime, None if it can't be converted
+    """
+    try:
+        return datetime.datetime.strptime(str(value), "%Y%m%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+
+def action_duration(sid, action_id, finished):
+    """
+    Get the duration of the action on the system, from the pickup time of the action to the time it finished.
+
+    :param sid: system id
+    :param action_id: id of the action
+    :param finished: timestamp of listCompletedSystems or listFailedSystems
+    :return: duration in seconds, None if not known
+    """
+    try:
+        details = smt.client.system.getEventDetails(smt.session, sid, action_id)
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: system.getEventDetails')
+        smt.log_debug(f"Error: \n{err}")
+        return None
+    picked_up = parse_time(details.get('picked_up'))
+    finished = parse_time(finished)
+    if not picked_up or not finished:
+        return None
+    return (finished - picked_up).total_seconds()
+
+
+def wait_for_highstate(actions):
+    """
+    Follow all actions until every system has completed or failed, or the timeout has passed. Every round the
+    completed and failed systems of the actions which still have running systems are read.
+
+    :param actions: dict with action id and the system ids of the action
+    :return: dict with system id and a tuple (result, duration in seconds or None, message)
+    """
+    end_time = time.monotonic() + smtools.CONFIGSM['suman']['timeout']
+    try:
+        wait_time = smtools.CONFIGSM['maintenance']['wait_between_events_check']
+    except KeyError:
+        wait_time = 30
+    results = {}
+    pending = {action_id: set(sids) for action_id, sids in actions.items()}
+    while pending and time.monotonic() < end_time:
+        time.sleep(wait_time)
+        for action_id in list(pending):
+            for result, systems in (("completed", smt.schedule_listcompletedsystems(action_id)),
+                                    ("failed", smt.schedule_listfailedsystems(action_id))):
+                for system in systems:
+                    sid = system.get('server_id')
+                    if sid in pending[action_id]:
+                        pending[action_id].discard(sid)
+                        results[sid] = (result, action_duration(sid, action_id, system.get('timestamp')),
+                                        system.get('message'))
+            if not pending[action_id]:
+                del pending[action_id]
+        smt.log_info(f"Still running on {sum(len(s) for s in pending.values())} servers")
+    for sids in pending.values():
+        for sid in sids:
+            results[sid] = ("timeout", None, None)
+    return results
+
+
+def report(targets, results):
+    """
+    Log the result per system and the totals
+    """
+    counts = {}
+    for sid, name in sorted(targets.items(), key=lambda t: t[1]):
+        result, duration, message = results.get(sid, ("not scheduled", None, None))
+        counts[result] = counts.get(result, 0) + 1
+        duration_text = f"{duration:.0f} seconds" if duration is not None else "unknown time"
+        if result == "completed":
+            smt.log_info(f"{name}: highstate completed in {duration_text}")
+        elif result == "not scheduled":
+            smt.minor_error(f"{name}: highstate not scheduled")
+        else:
+            smt.minor_error(f"{name}: highstate {result} after {duration_text}. {message or ''}")
+    smt.log_info(f"Highstate on {len(targets)} servers: "
+                 f"{', '.join(f'{count} {result}' for result, count in sorted(counts.items()))}")
+
+
+def highstate_many(args):
+    """
+    Perform the highstate on all systems of the group or file
+    """
+    if args.group:
+        targets = resolve_group(args.group)
+    else:
+        targets = resolve_file(args.file)
+    if not targets:
+        smt.minor_error("No servers found")
+        return
+    actions = schedule_highstate(targets, args.chunk, args.test)
+    results = wait_for_highstate(actions)
+    report(targets, results)
 
 
 def main():
     """
     Main function
     """
+    global smt
     try:
         parser = argparse.ArgumentParser(description="Update the give system.")
-        parser.add_argument('-s', '--server', help='name of the server to receive config update. Required')
+        parser.add_argument('-s', '--server', help='name of the server to receive config update.')
+        parser.add_argument('-g', '--group', help='name of the systemgroup. All systems in the group receive the config update.')
+        parser.add_argument('-f', '--file', help='file with the servers to receive the config update. 1 server per line.')
+        parser.add_argument('-c', '--chunk', type=int, default=100,
+                            help='number of servers per highstate action when using --group or --file. Default 100')
+        parser.add_argument('-t', '--test', action="store_true", default=0,
+                            help='run the highstate in test mode when using --group or --file.')
         parser.add_argument('--version', action='version', version='%(prog)s 2.0.0, July 29, 2025')
         args = parser.parse_args()
-        if not args.server:
+        if len([x for x in (args.server, args.group, args.file) if x]) != 1:
             smt = smtools.SMTools("system_highstate")
-            smt.log_error("The option --server is mandatory. Exiting script")
+            smt.log_error("One of the options --server, --group or --file is mandatory. Exiting script")
             smt.exit_program(1)
-        else:
+        elif args.server:
             smt = smtools.SMTools("system_highstate", args.server, True)
+        else:
+            smt = smtools.SMTools("system_highstate")
         # login to suse manager
         smt.log_info("Start")
         smt.log_debug("The following arguments are set: ")
         smt.log_debug(args)
         smt.suman_login()
-        smt.set_hostname(args.server)
-        smt.system_scheduleapplyhighstate(xmlrpc.client.DateTime(datetime.datetime.now()))
+        if args.server:
+            smt.set_hostname(args.server)
+            smt.system_scheduleapplyhighstate(xmlrpc.client.DateTime(datetime.datetime.now()))
+        else:
+            highstate_many(args)
         smt.close_program()
     except Exception as err:
         smt.log_error("general error:")
@@ -4,7 +4,7 @@
 # GNU Public License. No warranty. No Support
 # For question/suggestions/bugs mail: michael.brookhuis@suse.com
 #
-# Version: 2025-08-18
+# Version: 2026-10-19
 #
 # Created by: SUSE Michael Brookhuis
 #
@@ -12,11 +12,20 @@
 #
 # Releases:
 # 2025-08-18 M.Brookhuis - initial release.
+# 2026-10-19 - Distributions are updated in parallel, with a log per distribution. Distributions are skipped
+#              when the parent channel didn't change since the last successful update.
+#            - The fingerprint of the parent channel includes the number of packages, added --force
 #
 
 import argparse
+import os
 import subprocess
+import time
+import xmlrpc.client
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
 
 import smtools
 
@@ -87,48 +96,159 @@ def check_distros(distros, distro):
         smt.log_error(f"Distro {distro} not valid")
         return False
 
-def check_channel(channel):
+def check_channel(channels, channel):
     """
-    Check if the provided channel exists and can be retrieved by the system.
-
-    This function validates the existence of a channel by querying the system
-    for its details. If the channel does not exist or cannot be found, it logs
-    an error and returns False. Otherwise, it confirms the channel's validity
-    and returns True.
+    Check if the provided channel exists.
 
-    :param channel: The name or identifier of the channel to validate.
+    :param channels: Labels of all software channels.
+    :type channels: set or dict
+    :param channel: The label of the channel to validate.
     :type channel: str
-    :return: Returns True if the channel exists and can be successfully queried,
-        otherwise returns False.
+    :return: Returns True if the channel exists, otherwise returns False.
     :rtype: bool
     """
-    if not smt.channel_software_getdetails(channel, True):
+    if channel not in channels:
         smt.log_error(f"Channel {channel} not found")
         return False
     return True
 
-def start_update():
+def state_file():
+    """
+    Returns the file in which the state of the last successful updates is kept.
+
+    :return: path of the state file, set with bootstrap-repo|state_file in configsm.yaml.
+    :rtype: str
+    """
+    return smtools.CONFIGSM['bootstrap-repo'].get('state_file',
+                                                  os.path.join(os.path.dirname(__file__), "bootstrap_repo_state.yaml"))
+
+def load_state():
+    """
+    Loads the state of the last successful update of every distribution.
+
+    :return: dict with per distribution the fingerprint of the parent channel.
+    :rtype: dict
+    """
+    if not os.path.isfile(state_file()):
+        return {}
+    with open(state_file()) as h_state:
+        return smtools.load_yaml(h_state) or {}
+
+def save_state(state):
+    """
+    Saves the state of the last successful update of every distribution.
+
+    :param state: dict with per distribution the fingerprint of the parent channel.
+    :type state: dict
+    """
+    with open(state_file() + ".new", "w") as h_state:
+        yaml.safe_dump(state, h_state, default_flow_style=False)
+    os.replace(state_file() + ".new", state_file())
+
+def get_package_counts():
+    """
+    Returns the number of packages of all software channels with one listing.
+
+    :return: dict with the channel label and the number of packages.
+    :rtype: dict
+    """
+    try:
+        all_channels = smt.client.channel.listAllChannels(smt.session)
+    except xmlrpc.client.Fault as err:
+        smt.log_debug('api-call: channel.listAllChannels')
+        smt.log_debug(f"Error: \n{err}")
+        smt.fatal_error("Unable to get a list of all software channels")
+    return {c.get('label'): c.get('packages') for c in all_channels}
+
+def fingerprint(channel, packages):
+    """
+    Returns the fingerprint of the parent channel. When the fingerprint is the same as after the last
+    successful update, the bootstrap repository doesn't need to be updated.
+
+    :param channel: The label of the parent channel.
+    :type channel: str
+    :param packages: The number of packages in the parent channel.
+    :type packages: int
+    :return: dict with the channel label, its last modification and number of packages,
+        None when it can't be retrieved.
+    :rtype: dict
+    """
+    details = smt.channel_software_getdetails(channel, True)
+    if not details:
+        return None
+    return {'channel': channel, 'last_modified': str(details.get('last_modified')), 'packages': packages}
+
+def update_distro(dist, channel):
+    """
+    Runs the update of one distribution. The output of the command is written to a log file per distribution.
+
+    :param dist: The distribution to update.
+    :type dist: str
+    :param channel: The parent channel of the distribution.
+    :type channel: str
+    :return: return code of the command, the time it took and the log file.
+    :rtype: tuple
+    """
+    log_dir = os.path.join(smtools.CONFIGSM['dirs']['log_dir'], "update_bootstrap_repo")
+    os.makedirs(log_dir, exist_ok=True)
+    log_name = os.path.join(log_dir, f"{dist}.log")
+    command_dist = f"/usr/bin/{smtools.CONFIGSM['bootstrap-repo']['command']} -c {dist} --with-parent-channel={channel}"
+    start = time.monotonic()
+    with open(log_name, "a") as h_log:
+        h_log.write(f"==== {time.strftime('%d-%m-%Y %H:%M:%S')} {command_dist}\n")
+        h_log.flush()
+        result = subprocess.run(command_dist, shell=True, stdin=subprocess.DEVNULL, stdout=h_log,
+                                stderr=subprocess.STDOUT)
+    return result.returncode, time.monotonic() - start, log_name
+
+def start_update(jobs, force=False):
     """
     Triggers the update process for specified distributions and channels by executing a
     command for each valid distribution and channel combination. It performs checks
     to ensure compatibility of the provided distributions and channels before executing
-    the required commands. Logs success or failure for each operation.
+    the required commands. Distributions whose parent channel didn't change since the last
+    successful update are skipped, unless force is given. The others are updated with at most
+    jobs at the same time. Logs success or failure and the time needed for each operation.
 
+    :param jobs: Number of distributions updated at the same time.
+    :type jobs: int
+    :param force: Update all distributions, also when the parent channel didn't change.
+    :type force: bool
     :raises KeyError: If required configuration keys are missing from the
         ``smtools.CONFIGSM`` dictionary.
-    :raises AttributeError: If smt.log or related logging methods are incorrectly defined.
     """
     distros = get_distros()
+    channels = get_package_counts()
+    state = load_state()
+    todo = {}
     for dist, channel in smtools.CONFIGSM['bootstrap-repo']['repos'].items():
-        smt.log_info(f"Updating {dist} with {channel}")
-        if check_distros(distros, dist) and check_channel(channel):
-            command_dist = f"/usr/bin/{smtools.CONFIGSM['bootstrap-repo']['command']} -c {dist} --with-parent-channel={channel}"
-            result = execute_command(command_dist)
-            if result.returncode == 0:
-                smt.log.info("success")
+        if not (check_distros(distros, dist) and check_channel(channels, channel)):
+            continue
+        current = fingerprint(channel, channels[channel])
+        if not force and current and state.get(dist) == current:
+            smt.log_info(f"Skipping {dist}, {channel} not changed since last update")
+            continue
+        todo[dist] = (channel, current)
+    start = time.monotonic()
+    updated = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for dist, (channel, current) in todo.items():
+            smt.log_info(f"Updating {dist} with {channel}")
+            futures[executor.submit(update_distro, dist, channel)] = dist
+        for future in as_completed(futures):
+            dist = futures[future]
+            channel, current = todo[dist]
+            returncode, elapsed, log_name = future.result()
+            if returncode == 0:
+                smt.log_info(f"Updated {dist} in {elapsed:.0f} seconds")
+                updated += 1
+                if current:
+                    state[dist] = current
+                    save_state(state)
             else:
-                smt.log_error(f"Error updating {channel}")
-                smt.log_error(f"Error message: {result.stderr.decode('utf-8')}")
+                smt.log_error(f"Error updating {dist} with {channel} after {elapsed:.0f} seconds. See {log_name}")
+    smt.log_info(f"Updated {updated} of {len(todo)} distributions in {time.monotonic() - start:.0f} seconds")
 
 def main():
     """
@@ -146,11 +266,19 @@ def main():
          update_bootstrap_repo.py
 
          This script will update the bootstrap repositories. Which repositories are updated with which channel 
-         is defined in the config file. There are no parameters
+         is defined in the config file. The number of distributions updated at the same time is
+         set with bootstrap-repo|parallel in the config file or with --jobs.
+         A distribution is only updated when the parent channel changed since the last successful update.
                '''))
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=smtools.CONFIGSM['bootstrap-repo'].get('parallel', 2),
+                        help="Number of distributions updated at the same time. Default bootstrap-repo|parallel or 2")
+    parser.add_argument("-f", "--force", action="store_true", default=0,
+                        help="Update all distributions, also when the parent channel didn't change.")
+    args = parser.parse_args()
     smt.log_info("Start")
     smt.suman_login()
-    start_update()
+    start_update(args.jobs, args.force)
     smt.log_info("Finished update_bootstrap_repo")
     smt.close_program()
 